@@ -0,0 +1,283 @@
+import heapq
+import json
+import logging
+import os
+import threading
+import time
+from email.mime.text import MIMEText
+from email.mime.multipart import MIMEMultipart
+from StorageBackend import atomic_write
+from SubscriptionMetrics import REGISTRY
+
+logger = logging.getLogger("subscription.outbox")
+
+EMAILS_SENT = REGISTRY.counter("subscription_emails_sent_total", "Notifications sent.")
+EMAIL_FAILURES = REGISTRY.counter("subscription_email_failures_total", "Failed attempts to send a notification.")
+EMAILS_DEAD = REGISTRY.counter("subscription_emails_dead_total", "Notifications given up on after max_attempts.")
+SMTP_SEND_SECONDS = REGISTRY.histogram("subscription_smtp_send_duration_seconds",
+                                       "Time to send one message over SMTP, connecting included.", ("result",))
+OUTBOX_PENDING = REGISTRY.gauge("subscription_outbox_pending", "Notifications waiting to be sent.")
+
+# Keys of sent notifications are remembered this long, so a restart or a
+# second run on the same day never sends a notice twice
+SENT_KEY_RETENTION_SECONDS = 400 * 24 * 3600
+# The file is rewritten with only what is still relevant once at least this
+# many records were appended since the last rewrite (and more than it holds)
+COMPACT_MIN_RECORDS = 10000
+
+
+def build_message(sender_email, receiver_email, subject, body, html=None):
+    message = MIMEMultipart("alternative") if html else MIMEMultipart()
+    message['From'] = sender_email
+    message['To'] = receiver_email
+    message['Subject'] = subject
+    message.attach(MIMEText(body, 'plain'))
+    if html:
+        message.attach(MIMEText(html, 'html'))
+    return message
+
+
+# Notifications waiting to be sent, kept in an append-only JSONL file. Every
+# notification has an idempotency key; a key that was queued before is
+# ignored, whether it is still pending or was already sent. A notification
+# given up on after max_attempts is not lost: it is queued again when the
+# outbox is opened (the checker restarts) or when its key is queued again.
+class Outbox:
+    def __init__(self, path, max_attempts=8, retry_base_seconds=30):
+        self.path = path
+        self.max_attempts = max_attempts
+        self.retry_base_seconds = retry_base_seconds
+
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._pending = {}      # key -> notification
+        self._sent = {}         # key -> time it was sent
+        self._dead = {}         # key -> notification given up on
+        self._due = []          # heap of (next_attempt, key) for pending keys not being sent
+        self._in_flight = set()
+        self._file = None
+        self._records = 0       # records appended since the file was last rewritten
+
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.path, "r") as file:
+                for line in file:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+                    key = record["key"]
+                    event = record["event"]
+                    if event == "queued":
+                        self._pending[key] = record["notification"]
+                    elif event == "failed" and key in self._pending:
+                        self._pending[key].update(attempts=record["attempts"], next_attempt=record["next_attempt"])
+                    elif event == "sent":
+                        self._pending.pop(key, None)
+                        self._sent[key] = record["time"]
+                    elif event == "dead" and key in self._pending:
+                        self._dead[key] = self._pending.pop(key)
+        except FileNotFoundError:
+            pass
+
+        # Notifications given up on in an earlier run get a new round of attempts
+        if self._dead:
+            logger.warning("Queueing notifications given up on again", extra={"fields": {"count": len(self._dead)}})
+        for key, notification in self._dead.items():
+            self._pending[key] = dict(notification, attempts=0, next_attempt=0)
+        self._dead = {}
+
+        self._compact()
+        self._due = [(notification.get("next_attempt", 0), key) for key, notification in self._pending.items()]
+        heapq.heapify(self._due)
+        OUTBOX_PENDING.set(len(self._pending))
+
+    # Called with the lock held (or from _load): rewrite the file with what is
+    # still relevant, so it does not grow forever
+    def _compact(self):
+        cutoff = time.time() - SENT_KEY_RETENTION_SECONDS
+        self._sent = {key: sent_at for key, sent_at in self._sent.items() if sent_at >= cutoff}
+        lines = [json.dumps({"event": "sent", "key": key, "time": sent_at}) for key, sent_at in self._sent.items()]
+        lines += [json.dumps({"event": "queued", "key": key, "notification": notification})
+                  for key, notification in self._pending.items()]
+        # Dead notices are kept as a queued record followed by a dead one
+        for key, notification in self._dead.items():
+            lines.append(json.dumps({"event": "queued", "key": key, "notification": notification}))
+            lines.append(json.dumps({"event": "dead", "key": key, "time": time.time()}))
+        # The file is replaced, so the handle appending to it is reopened
+        if self._file is not None:
+            self._file.close()
+        atomic_write(self.path, "".join(line + "\n" for line in lines))
+        self._file = open(self.path, "a")
+        self._records = 0
+
+    # Called with the lock held
+    def _write(self, record):
+        self._file.write(json.dumps(record) + "\n")
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self._records += 1
+
+    # Called with the lock held, after the change written is applied in memory
+    def _compact_if_needed(self):
+        if self._records >= max(COMPACT_MIN_RECORDS, len(self._sent) + len(self._pending) + len(self._dead)):
+            self._compact()
+
+    def enqueue(self, key, receiver_email, subject, body, html=None):
+        with self._lock:
+            if key in self._pending or key in self._sent:
+                return False
+            notification = {"receiver_email": receiver_email, "subject": subject, "body": body, "html": html,
+                            "attempts": 0, "next_attempt": 0}
+            self._write({"event": "queued", "key": key, "notification": notification})
+            self._dead.pop(key, None)
+            self._pending[key] = notification
+            self._compact_if_needed()
+            heapq.heappush(self._due, (0, key))
+            OUTBOX_PENDING.set(len(self._pending))
+            self._changed.notify_all()
+            return True
+
+    # Take the next notification that is due, waiting up to timeout seconds.
+    # Returns (key, notification) or None.
+    def claim(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            while True:
+                now = time.time()
+                if self._due and self._due[0][0] <= now:
+                    _, key = heapq.heappop(self._due)
+                    self._in_flight.add(key)
+                    return key, dict(self._pending[key])
+                wait = self._due[0][0] - now if self._due else None
+                if deadline is not None:
+                    if now >= deadline:
+                        return None
+                    wait = min(wait, deadline - now) if wait is not None else deadline - now
+                self._changed.wait(wait)
+
+    def mark_sent(self, key):
+        with self._lock:
+            now = time.time()
+            self._write({"event": "sent", "key": key, "time": now})
+            self._in_flight.discard(key)
+            self._pending.pop(key, None)
+            self._sent[key] = now
+            self._compact_if_needed()
+            OUTBOX_PENDING.set(len(self._pending))
+            self._changed.notify_all()
+
+    # Schedule another attempt with exponential backoff, or give up after max_attempts
+    def mark_failed(self, key, error):
+        with self._lock:
+            self._in_flight.discard(key)
+            notification = self._pending[key]
+            attempts = notification["attempts"] + 1
+            now = time.time()
+            if attempts >= self.max_attempts:
+                self._write({"event": "dead", "key": key, "time": now, "error": str(error)})
+                self._dead[key] = self._pending.pop(key)
+                OUTBOX_PENDING.set(len(self._pending))
+                EMAILS_DEAD.inc()
+                logger.error("Giving up on notification until the checker restarts", extra={"fields": {
+                    "key": key, "attempts": attempts, "error": str(error)}})
+            else:
+                next_attempt = now + self.retry_base_seconds * 2 ** (attempts - 1)
+                self._write({"event": "failed", "key": key, "attempts": attempts, "next_attempt": next_attempt,
+                             "error": str(error)})
+                notification.update(attempts=attempts, next_attempt=next_attempt)
+                heapq.heappush(self._due, (next_attempt, key))
+            self._compact_if_needed()
+            self._changed.notify_all()
+
+    # Wait until nothing is left to send right now (retries scheduled for later
+    # do not count). Returns False on timeout.
+    def wait_idle(self, timeout=None):
+        deadline = time.time() + timeout if timeout is not None else None
+        with self._lock:
+            while self._in_flight or (self._due and self._due[0][0] <= time.time()):
+                remaining = deadline - time.time() if deadline is not None else None
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._changed.wait(remaining)
+            return True
+
+    def wake_all(self):
+        with self._lock:
+            self._changed.notify_all()
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+# Limits sends to rate_per_second across all workers
+class RateLimiter:
+    def __init__(self, rate_per_second):
+        self.interval = 1.0 / rate_per_second if rate_per_second > 0 else 0
+        self._lock = threading.Lock()
+        self._next_slot = time.monotonic()
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(self._next_slot, now)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# Worker threads draining the outbox. Each worker owns an SMTP session made by
+# session_factory, which it keeps open while there is work and closes when idle.
+class EmailDispatcher:
+    def __init__(self, outbox, session_factory, sender_email, workers=4, rate_limit_per_second=5):
+        self.outbox = outbox
+        self.session_factory = session_factory
+        self.sender_email = sender_email
+        self.workers = workers
+        self.rate_limiter = RateLimiter(rate_limit_per_second)
+        self.running = False
+        self._threads = []
+
+    def start(self):
+        self.running = True
+        for number in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f"email-dispatcher-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        self.running = False
+        self.outbox.wake_all()
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def _work(self):
+        session = self.session_factory()
+        while self.running:
+            claimed = self.outbox.claim(timeout=1)
+            if claimed is None:
+                session.close()
+                continue
+            key, notification = claimed
+            message = build_message(self.sender_email, notification["receiver_email"], notification["subject"],
+                                    notification["body"], notification.get("html"))
+            self.rate_limiter.acquire()
+            start = time.perf_counter()
+            try:
+                session.send(message, notification["receiver_email"])
+            except Exception as e:
+                SMTP_SEND_SECONDS.observe(time.perf_counter() - start, result="error")
+                EMAIL_FAILURES.inc()
+                logger.warning("Error sending notification", extra={"fields": {"key": key, "error": str(e)}})
+                session.close()
+                self.outbox.mark_failed(key, e)
+            else:
+                SMTP_SEND_SECONDS.observe(time.perf_counter() - start, result="ok")
+                EMAILS_SENT.inc()
+                logger.debug("Notification sent", extra={"fields": {"key": key}})
+                self.outbox.mark_sent(key)
+        session.close()
@@ -0,0 +1,699 @@
+import json
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import configparser
+from contextlib import nullcontext
+from SubscriptionMetrics import StorageOperation
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
+
+logger = logging.getLogger("subscription.storage")
+
+SUBSCRIPTIONS_FILE = "subscriptions.json"
+PRODUCTS_FILE = "products.json"
+META_FILE = "store_meta.json"
+JOURNAL_FILE = "journal.jsonl"
+# While a compaction runs, the journal being folded into the snapshot is kept
+# under this name and new operations go to a fresh journal
+COMPACTING_FILE = "journal.jsonl.compacting"
+SQLITE_FILE = "subscriptions.db"
+# Held by the process that writes, when several API workers share the data
+LOCK_FILE = "store.lock"
+
+
+def file_size(path):
+    try:
+        return os.path.getsize(path)
+    except FileNotFoundError:
+        return 0
+
+
+# Read a JSON document from disk, an absent file gives the default
+def read_json(path, default):
+    try:
+        with open(path, "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return default
+
+
+# Read once at import: os.umask() can only be read by setting it, which
+# would briefly affect files other threads create
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+
+
+# Permissions of a file written over path: those of the existing file, or
+# what open() gives a new one
+def file_mode(path):
+    try:
+        return os.stat(path).st_mode & 0o7777
+    except FileNotFoundError:
+        return 0o666 & ~_UMASK
+
+
+# Write the file next to its destination and rename it over the old one, so a
+# crash in the middle of a write never leaves a half written file behind.
+# mkstemp creates the file owner-only, it gets the mode of the file it
+# replaces so other users (the checker) can still read it.
+def atomic_write(path, content):
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix=".tmp-", dir=directory)
+    try:
+        with os.fdopen(fd, "w") as file:
+            file.write(content)
+            file.flush()
+            os.fsync(file.fileno())
+        os.chmod(tmp_path, file_mode(path))
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+# Read the operations of a journal file. A crash can leave the last line half
+# written, everything from the first unreadable line on is ignored.
+def read_journal(path):
+    return read_journal_from(path, 0)[0]
+
+
+# Operations from byte offset on, with the offset right after the last one read
+def read_journal_from(path, offset):
+    operations = []
+    try:
+        with open(path, "rb") as file:
+            file.seek(offset)
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    operations.append(json.loads(line))
+                except ValueError:
+                    break
+                offset += len(line)
+    except FileNotFoundError:
+        pass
+    return operations, offset
+
+
+# Exclusive lock on a file, shared by every process that opens the same path:
+# fcntl.flock on Unix, msvcrt.locking on Windows. It is reentrant and also
+# excludes the other threads of the process.
+class FileLock:
+    def __init__(self, path):
+        self.path = path
+        self._thread_lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def __enter__(self):
+        self._thread_lock.acquire()
+        if self._depth == 0:
+            try:
+                if self._file is None:
+                    self._file = open(self.path, "a+")
+                if fcntl is not None:
+                    fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+                else:
+                    self._file.seek(0)
+                    while True:
+                        try:
+                            # Gives up after about 10 seconds, keep waiting
+                            msvcrt.locking(self._file.fileno(), msvcrt.LK_LOCK, 1)
+                            break
+                        except OSError:
+                            pass
+            except BaseException:
+                self._thread_lock.release()
+                raise
+        self._depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._depth -= 1
+        if self._depth == 0:
+            if fcntl is not None:
+                fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            else:
+                self._file.seek(0)
+                msvcrt.locking(self._file.fileno(), msvcrt.LK_UNLCK, 1)
+        self._thread_lock.release()
+
+    def close(self):
+        with self._thread_lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+# Cut a half written last line off the journal, so new operations are not
+# appended behind it where replay would never reach them
+def repair_journal(path):
+    try:
+        with open(path, "rb+") as file:
+            valid_size = 0
+            for line in file:
+                try:
+                    json.loads(line)
+                except ValueError:
+                    break
+                if not line.endswith(b"\n"):
+                    break
+                valid_size += len(line)
+            file.truncate(valid_size)
+    except FileNotFoundError:
+        pass
+
+
+# Apply one journal operation to the in-memory state. Every operation is
+# idempotent, so replaying a journal that was already folded into the snapshot
+# (a crash during compaction) gives the same result.
+def apply_operation(state, operation):
+    op = operation["op"]
+    if op == "add":
+        subscription = operation["subscription"]
+        state["subscriptions"][subscription["index"]] = subscription
+        state["next_index"] = max(state["next_index"], subscription["index"] + 1)
+    elif op == "delete":
+        state["subscriptions"].pop(operation["index"], None)
+    elif op == "renew":
+        subscription = state["subscriptions"].get(operation["index"])
+        if subscription is not None:
+            if operation.get("end_date"):
+                subscription["end_date"] = operation["end_date"]
+            if operation.get("license_key"):
+                subscription["license_key"] = operation["license_key"]
+            # Journals written before versions existed carry none
+            subscription["version"] = operation.get("version") or subscription.get("version", 1) + 1
+    elif op == "add_product":
+        state["products"].setdefault(operation["product_name"], None)
+    elif op == "delete_product":
+        state["products"].pop(operation["product_name"], None)
+    state["last_seq"] = max(state["last_seq"], operation.get("seq", 0))
+
+
+# Interface of the storage layer behind SubscriptionStore. The store keeps the
+# data in memory and hands every batch of changes to append(); snapshots of
+# the whole data set are only written through save_snapshot().
+class StorageBackend:
+    # True when other processes write to the same data. The store then makes
+    # every change under locked() and calls sync() to see theirs first.
+    shared = False
+    _file_lock = None
+
+    # Load everything as a state dict: subscriptions (dict keyed by index),
+    # products (dict of name -> None, an insertion ordered set), next_index and
+    # last_seq. Snapshots hold both as lists.
+    def load_state(self):
+        raise NotImplementedError
+
+    def load_subscriptions(self):
+        return list(self.load_state()["subscriptions"].values())
+
+    def load_products(self):
+        return list(self.load_state()["products"])
+
+    # Called once by the store that owns the backend, before the first write
+    def recover(self, state):
+        pass
+
+    # Cross-process lock around writes, a no-op when the data is not shared
+    def locked(self):
+        return self._file_lock if self._file_lock is not None else nullcontext()
+
+    # Whether other processes may have changed the data since the last
+    # load_state(), sync() or append() of this backend
+    def changed(self):
+        return False
+
+    # Catch up with the changes of other processes, called under locked().
+    # Returns (operations, None) with the operations to apply, or (None, state)
+    # with a freshly loaded state when they cannot be replayed.
+    def sync(self):
+        return [], None
+
+    # Cheap value that changes whenever the stored data changes, so readers
+    # can skip reloading unchanged data. None when the backend cannot tell.
+    def fingerprint(self):
+        return None
+
+    # Persist a batch of operations durably
+    def append(self, operations):
+        raise NotImplementedError
+
+    # Replace the stored data with a full snapshot
+    def save_snapshot(self, snapshot):
+        raise NotImplementedError
+
+    def save_subscriptions(self, subscriptions):
+        state = self.load_state()
+        self.save_snapshot({
+            "subscriptions": subscriptions,
+            "products": list(state["products"]),
+            "next_index": max([state["next_index"]] + [s.get("index", 0) + 1 for s in subscriptions]),
+            "last_seq": state["last_seq"],
+        })
+
+    def save_products(self, products):
+        state = self.load_state()
+        state["subscriptions"] = list(state["subscriptions"].values())
+        state["products"] = list(products)
+        self.save_snapshot(state)
+
+    # Compaction support, only backends with a journal need it
+    def needs_compaction(self, threshold_bytes=None):
+        return False
+
+    def begin_compaction(self):
+        pass
+
+    def finish_compaction(self, snapshot):
+        pass
+
+    def close(self):
+        pass
+
+
+# subscriptions.json and products.json as snapshots, plus journal.jsonl with
+# the operations applied since the last snapshot
+class JsonFileBackend(StorageBackend):
+    def __init__(self, data_dir, compact_threshold_bytes=1024 * 1024, shared=False):
+        self.data_dir = data_dir
+        self.subscriptions_file = os.path.join(data_dir, SUBSCRIPTIONS_FILE)
+        self.products_file = os.path.join(data_dir, PRODUCTS_FILE)
+        self.meta_file = os.path.join(data_dir, META_FILE)
+        self.journal_file = os.path.join(data_dir, JOURNAL_FILE)
+        self.compacting_file = os.path.join(data_dir, COMPACTING_FILE)
+        self.compact_threshold_bytes = compact_threshold_bytes
+        # The journal is opened on the first write
+        self._journal = None
+        self._journal_size = 0
+
+        self.shared = shared
+        if shared:
+            self._file_lock = FileLock(os.path.join(data_dir, LOCK_FILE))
+        # How far this process has read the journal, and the meta file it saw;
+        # a new meta file means another process compacted the journal
+        self._journal_offset = 0
+        self._meta_stat = None
+
+    # Load the last snapshot and replay the journal on top of it
+    def load_state(self):
+        with StorageOperation("json", "load") as measured:
+            # Subscriptions are kept in a dict keyed by their index, which keeps the
+            # insertion order of the file and gives constant time lookups
+            subscriptions = {}
+            for subscription in read_json(self.subscriptions_file, []):
+                subscriptions[subscription.get("index", 0)] = subscription
+            self._meta_stat = self._stat(self.meta_file)
+            meta = read_json(self.meta_file, {})
+            state = {
+                "subscriptions": subscriptions,
+                "products": dict.fromkeys(read_json(self.products_file, [])),
+                # Indexes are handed out by a persisted counter so they are never reused,
+                # even after the subscription holding the highest index is deleted
+                "next_index": max(meta.get("next_index", 1), max(subscriptions, default=0) + 1),
+                "last_seq": meta.get("last_seq", 0),
+            }
+            snapshot_seq = state["last_seq"]
+            for operation in read_journal(self.compacting_file):
+                if operation.get("seq", 0) > snapshot_seq:
+                    apply_operation(state, operation)
+            operations, self._journal_offset = read_journal_from(self.journal_file, 0)
+            for operation in operations:
+                if operation.get("seq", 0) > snapshot_seq:
+                    apply_operation(state, operation)
+            measured.bytes = sum(file_size(path) for path in (self.subscriptions_file, self.products_file,
+                                                              self.meta_file, self.compacting_file))
+            measured.bytes += self._journal_offset
+        return state
+
+    def _stat(self, path):
+        try:
+            stat = os.stat(path)
+            return (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+        except FileNotFoundError:
+            return None
+
+    def _journal_file_size(self):
+        return file_size(self.journal_file)
+
+    def changed(self):
+        return self._stat(self.meta_file) != self._meta_stat or self._journal_file_size() != self._journal_offset
+
+    # The journal tail other processes appended, or everything again when one
+    # of them compacted the journal in the meantime
+    def sync(self):
+        size = self._journal_file_size()
+        if self._stat(self.meta_file) != self._meta_stat or size < self._journal_offset:
+            state = self.load_state()
+            self._journal_size = self._journal_offset
+            return None, state
+        if size == self._journal_offset:
+            return [], None
+        with StorageOperation("json", "sync") as measured:
+            offset = self._journal_offset
+            operations, self._journal_offset = read_journal_from(self.journal_file, offset)
+            measured.bytes = self._journal_offset - offset
+        self._journal_size = self._journal_offset
+        return operations, None
+
+    # Called by the owner of the files before the first write
+    def recover(self, state):
+        repair_journal(self.journal_file)
+        # A compaction interrupted by a crash is finished before anything else
+        # touches the journal
+        if os.path.exists(self.compacting_file):
+            snapshot = dict(state, subscriptions=list(state["subscriptions"].values()), products=list(state["products"]))
+            self.save_snapshot(snapshot)
+            os.remove(self.compacting_file)
+            if os.path.exists(self.journal_file):
+                os.remove(self.journal_file)
+        self._journal_size = self._journal_offset = self._journal_file_size()
+
+    # Modification time and size of every file the data is read from
+    def fingerprint(self):
+        stats = []
+        for path in (self.subscriptions_file, self.products_file, self.meta_file, self.compacting_file,
+                     self.journal_file):
+            try:
+                stat = os.stat(path)
+                stats.append((stat.st_mtime_ns, stat.st_size))
+            except FileNotFoundError:
+                stats.append(None)
+        return tuple(stats)
+
+    # Each batch is appended to the journal and fsync'd once. A shared journal
+    # is opened for every batch, since other processes may have swapped it out.
+    def append(self, operations):
+        with StorageOperation("json", "append") as measured:
+            content = "".join(json.dumps(operation) + "\n" for operation in operations)
+            if self._journal is not None and self.shared:
+                self._journal.close()
+                self._journal = None
+            if self._journal is None:
+                self._journal = open(self.journal_file, "a")
+            self._journal.write(content)
+            self._journal.flush()
+            os.fsync(self._journal.fileno())
+            measured.bytes = len(content.encode("utf-8"))
+        self._journal_size += measured.bytes
+        self._journal_offset = self._journal_size
+
+    def save_snapshot(self, snapshot):
+        with StorageOperation("json", "snapshot") as measured:
+            contents = [
+                (self.subscriptions_file, json.dumps(snapshot["subscriptions"])),
+                (self.products_file, json.dumps(snapshot["products"])),
+                # The meta file is written last, its last_seq marks the snapshot as complete
+                (self.meta_file, json.dumps({"next_index": snapshot["next_index"], "last_seq": snapshot["last_seq"]})),
+            ]
+            for path, content in contents:
+                atomic_write(path, content)
+                measured.bytes += len(content.encode("utf-8"))
+        self._meta_stat = self._stat(self.meta_file)
+
+    def needs_compaction(self, threshold_bytes=None):
+        if threshold_bytes is None:
+            threshold_bytes = self.compact_threshold_bytes
+        return self._journal_size > 0 and self._journal_size >= threshold_bytes
+
+    # Swap the journal out, new operations go to a fresh file
+    def begin_compaction(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if os.path.exists(self.journal_file):
+            os.replace(self.journal_file, self.compacting_file)
+        self._journal_size = self._journal_offset = 0
+
+    def finish_compaction(self, snapshot):
+        self.save_snapshot(snapshot)
+        if os.path.exists(self.compacting_file):
+            os.remove(self.compacting_file)
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+        if self._file_lock is not None:
+            self._file_lock.close()
+
+
+# SQLite database in WAL mode. Known fields get their own indexed columns,
+# anything else a client sends is kept in the extra column as JSON.
+class SqliteBackend(StorageBackend):
+    COLUMNS = ("client_name", "product_name", "end_date", "license_key", "version")
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS subscriptions ("
+        " idx INTEGER PRIMARY KEY, client_name TEXT, product_name TEXT,"
+        " end_date TEXT, license_key TEXT, extra TEXT, version INTEGER NOT NULL DEFAULT 1)",
+        "CREATE INDEX IF NOT EXISTS subscriptions_end_date ON subscriptions (end_date)",
+        "CREATE INDEX IF NOT EXISTS subscriptions_client_name ON subscriptions (client_name)",
+        "CREATE INDEX IF NOT EXISTS subscriptions_product_name ON subscriptions (product_name)",
+        "CREATE TABLE IF NOT EXISTS products (position INTEGER PRIMARY KEY AUTOINCREMENT, name TEXT UNIQUE NOT NULL)",
+        "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value INTEGER NOT NULL)",
+        # The latest operations as JSON, written by processes sharing the
+        # database so the others can replay them instead of reloading
+        "CREATE TABLE IF NOT EXISTS operations (seq INTEGER PRIMARY KEY, operation TEXT NOT NULL)",
+    )
+    # Operations kept in the operations table; a process further behind reloads
+    OPERATIONS_KEPT = 10000
+
+    # Statements are constants with placeholders, so sqlite3 prepares each of
+    # them once and reuses it from its statement cache
+    INSERT_SUBSCRIPTION = ("INSERT OR REPLACE INTO subscriptions"
+                           " (idx, client_name, product_name, end_date, license_key, version, extra)"
+                           " VALUES (?, ?, ?, ?, ?, ?, ?)")
+    DELETE_SUBSCRIPTION = "DELETE FROM subscriptions WHERE idx = ?"
+    RENEW_SUBSCRIPTION = ("UPDATE subscriptions SET end_date = COALESCE(?, end_date),"
+                          " license_key = COALESCE(?, license_key), version = COALESCE(?, version + 1)"
+                          " WHERE idx = ?")
+    INSERT_PRODUCT = "INSERT OR IGNORE INTO products (name) VALUES (?)"
+    DELETE_PRODUCT = "DELETE FROM products WHERE name = ?"
+    SET_META = "INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)"
+    SELECT_SUBSCRIPTIONS = ("SELECT idx, client_name, product_name, end_date, license_key, version, extra"
+                            " FROM subscriptions")
+    INSERT_OPERATION = "INSERT OR REPLACE INTO operations (seq, operation) VALUES (?, ?)"
+    PRUNE_OPERATIONS = "DELETE FROM operations WHERE seq <= ?"
+    SELECT_OPERATIONS = "SELECT seq, operation FROM operations WHERE seq > ? ORDER BY seq"
+
+    def __init__(self, db_path, shared=False):
+        self.db_path = db_path
+        self.shared = shared
+        if shared:
+            self._file_lock = FileLock(db_path + ".lock")
+        # data_version seen by the last load_state() or sync(), it does not
+        # change for this connection's own commits
+        self._data_version = None
+        # last_seq of the data this backend last loaded, synced or wrote
+        self._synced_seq = None
+        self._lock = threading.Lock()
+        # The connection is shared by the request, flush and compaction threads,
+        # access to it is serialized by self._lock
+        self._connection = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=FULL")
+        for statement in self.SCHEMA:
+            self._connection.execute(statement)
+        # Databases created before subscriptions had versions
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(subscriptions)")]
+        if "version" not in columns:
+            self._connection.execute("ALTER TABLE subscriptions ADD COLUMN version INTEGER NOT NULL DEFAULT 1")
+
+    def _row_to_subscription(self, row):
+        index, client_name, product_name, end_date, license_key, version, extra = row
+        subscription = {
+            "client_name": client_name,
+            "product_name": product_name,
+            "end_date": end_date,
+            "license_key": license_key,
+            "version": version,
+        }
+        if extra:
+            subscription.update(json.loads(extra))
+        subscription["index"] = index
+        return subscription
+
+    def _subscription_to_row(self, subscription):
+        extra = {key: value for key, value in subscription.items() if key not in self.COLUMNS and key != "index"}
+        values = dict(subscription, version=subscription.get("version", 1))
+        return (subscription["index"],) + tuple(values.get(column) for column in self.COLUMNS) + (
+            json.dumps(extra) if extra else None,)
+
+    def _meta(self):
+        return dict(self._connection.execute("SELECT key, value FROM meta").fetchall())
+
+    def load_state(self):
+        with self._lock, StorageOperation("sqlite", "load"):
+            subscriptions = {}
+            for row in self._connection.execute(self.SELECT_SUBSCRIPTIONS + " ORDER BY idx"):
+                subscription = self._row_to_subscription(row)
+                subscriptions[subscription["index"]] = subscription
+            products = dict.fromkeys(name for (name,) in self._connection.execute("SELECT name FROM products ORDER BY position"))
+            meta = self._meta()
+            self._data_version = self._connection.execute("PRAGMA data_version").fetchone()[0]
+            self._synced_seq = meta.get("last_seq", 0)
+        return {
+            "subscriptions": subscriptions,
+            "products": products,
+            "next_index": max(meta.get("next_index", 1), max(subscriptions, default=0) + 1),
+            "last_seq": meta.get("last_seq", 0),
+        }
+
+    # data_version changes when another connection commits to the database
+    def fingerprint(self):
+        with self._lock:
+            return self._connection.execute("PRAGMA data_version").fetchone()[0]
+
+    def changed(self):
+        return self.fingerprint() != self._data_version
+
+    # Replays what other processes wrote since the last sync from the
+    # operations table. A gap (a process that does not share the database
+    # wrote, or this one fell more than OPERATIONS_KEPT behind) means a full
+    # reload.
+    def sync(self):
+        if not self.changed():
+            return [], None
+        with self._lock, StorageOperation("sqlite", "sync"):
+            data_version = self._connection.execute("PRAGMA data_version").fetchone()[0]
+            last_seq = self._meta().get("last_seq", 0)
+            rows = self._connection.execute(self.SELECT_OPERATIONS, (self._synced_seq or 0,)).fetchall()
+        seqs = [seq for seq, _ in rows]
+        if self._synced_seq is None or last_seq < self._synced_seq or (
+                last_seq > self._synced_seq and seqs != list(range(self._synced_seq + 1, last_seq + 1))):
+            return None, self.load_state()
+        self._data_version = data_version
+        self._synced_seq = last_seq
+        return [json.loads(operation) for _, operation in rows], None
+
+    def is_empty(self):
+        with self._lock:
+            meta = self._meta()
+            count = self._connection.execute("SELECT COUNT(*) FROM subscriptions").fetchone()[0]
+        return not meta and not count
+
+    # One transaction per batch
+    def append(self, operations):
+        with self._lock, StorageOperation("sqlite", "append"):
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                for operation in operations:
+                    op = operation["op"]
+                    if op == "add":
+                        cursor.execute(self.INSERT_SUBSCRIPTION, self._subscription_to_row(operation["subscription"]))
+                        cursor.execute(
+                            "INSERT INTO meta (key, value) VALUES ('next_index', ?)"
+                            " ON CONFLICT(key) DO UPDATE SET value = MAX(value, excluded.value)",
+                            (operation["subscription"]["index"] + 1,))
+                    elif op == "delete":
+                        cursor.execute(self.DELETE_SUBSCRIPTION, (operation["index"],))
+                    elif op == "renew":
+                        cursor.execute(self.RENEW_SUBSCRIPTION, (operation.get("end_date") or None,
+                                                                 operation.get("license_key") or None,
+                                                                 operation.get("version"),
+                                                                 operation["index"]))
+                    elif op == "add_product":
+                        cursor.execute(self.INSERT_PRODUCT, (operation["product_name"],))
+                    elif op == "delete_product":
+                        cursor.execute(self.DELETE_PRODUCT, (operation["product_name"],))
+                if operations:
+                    last_seq = operations[-1].get("seq", 0)
+                    cursor.execute(self.SET_META, ("last_seq", last_seq))
+                    if self.shared:
+                        cursor.executemany(self.INSERT_OPERATION, ((operation["seq"], json.dumps(operation))
+                                                                   for operation in operations[-self.OPERATIONS_KEPT:]))
+                        cursor.execute(self.PRUNE_OPERATIONS, (last_seq - self.OPERATIONS_KEPT,))
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            if operations:
+                self._synced_seq = operations[-1].get("seq", 0)
+
+    def save_snapshot(self, snapshot):
+        with self._lock, StorageOperation("sqlite", "snapshot"):
+            cursor = self._connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                cursor.execute("DELETE FROM subscriptions")
+                cursor.execute("DELETE FROM products")
+                # Operations before a snapshot cannot be replayed on top of it
+                cursor.execute("DELETE FROM operations")
+                cursor.executemany(self.INSERT_SUBSCRIPTION,
+                                   (self._subscription_to_row(s) for s in snapshot["subscriptions"]))
+                cursor.executemany(self.INSERT_PRODUCT, ((name,) for name in snapshot["products"]))
+                cursor.execute(self.SET_META, ("next_index", snapshot["next_index"]))
+                cursor.execute(self.SET_META, ("last_seq", snapshot["last_seq"]))
+                cursor.execute("COMMIT")
+            except BaseException:
+                cursor.execute("ROLLBACK")
+                raise
+            self._synced_seq = snapshot["last_seq"]
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+        if self._file_lock is not None:
+            self._file_lock.close()
+
+
+# One shot copy of the JSON files (snapshot + journal) into a SQLite database
+def migrate_json_to_sqlite(data_dir, sqlite_backend):
+    state = JsonFileBackend(data_dir).load_state()
+    state["subscriptions"] = list(state["subscriptions"].values())
+    state["products"] = list(state["products"])
+    sqlite_backend.save_snapshot(state)
+    return len(state["subscriptions"]), len(state["products"])
+
+
+# Create the backend selected in the [Storage] section of config.ini
+# shared is for several processes writing the same data (API workers)
+def create_backend(config, data_dir, shared=False):
+    backend = config.get("Storage", "backend", fallback="json")
+    if backend == "json":
+        return JsonFileBackend(data_dir, config.getint("Storage", "compact_threshold_bytes", fallback=1024 * 1024),
+                               shared)
+    if backend == "sqlite":
+        db_path = os.path.join(data_dir, config.get("Storage", "sqlite_file", fallback=SQLITE_FILE))
+        sqlite_backend = SqliteBackend(db_path, shared)
+        # The first start on SQLite takes over the data of the JSON files
+        with sqlite_backend.locked():
+            if sqlite_backend.is_empty() and os.path.exists(os.path.join(data_dir, SUBSCRIPTIONS_FILE)):
+                subscriptions, products = migrate_json_to_sqlite(data_dir, sqlite_backend)
+                logger.info("Migrated the JSON files to SQLite", extra={"fields": {
+                    "subscriptions": subscriptions, "products": products, "database": db_path}})
+        return sqlite_backend
+    raise ValueError(f"Unknown storage backend: {backend}")
+
+
+if __name__ == "__main__":
+    # python StorageBackend.py migrate [database file]
+    if len(sys.argv) < 2 or sys.argv[1] != "migrate":
+        print("Usage: python StorageBackend.py migrate [database file]")
+        sys.exit(1)
+    if getattr(sys, 'frozen', False):
+        script_dir = os.path.dirname(sys.executable)
+    else:
+        script_dir = os.path.dirname(os.path.abspath(__file__))
+    config = configparser.ConfigParser()
+    config.read(os.path.join(script_dir, "config.ini"))
+    db_file = sys.argv[2] if len(sys.argv) > 2 else config.get("Storage", "sqlite_file", fallback=SQLITE_FILE)
+    sqlite_backend = SqliteBackend(os.path.join(script_dir, db_file))
+    subscriptions, products = migrate_json_to_sqlite(script_dir, sqlite_backend)
+    sqlite_backend.close()
+    print(f"Migrated {subscriptions} subscriptions and {products} products to {db_file}")
@@ -0,0 +1,102 @@
+import logging
+import threading
+import time
+from collections import OrderedDict
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger("subscription.gui.api")
+
+# Cached GET responses kept for conditional requests
+RESPONSE_CACHE_SIZE = 32
+
+
+# Every call to the API goes through one requests.Session, so connections are
+# kept alive and reused instead of opening a new one per request. Connection
+# failures are retried with backoff (for any method, the request never reached
+# the API), 502/503/504 answers only for idempotent methods.
+# Whether the API is online is known from the outcome of the real requests;
+# check_online() only sends a heartbeat when nothing was heard for a while.
+class ApiClient:
+    def __init__(self, host, port, timeout=10, retries=3, heartbeat_seconds=30):
+        self.base_url = f"http://{host}:{port}"
+        # (connect timeout, read timeout)
+        self.timeout = (min(timeout, 5), timeout)
+        self.heartbeat_seconds = heartbeat_seconds
+
+        retry = Retry(total=retries, connect=retries, read=retries, status=retries, backoff_factor=0.3,
+                      status_forcelist=(502, 503, 504), raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=10, max_retries=retry)
+        self.session = requests.Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.online = None
+        self.last_contact = None
+        # Last response of each GET, reused while the API answers 304 Not Modified
+        self.response_cache = OrderedDict()
+        self._lock = threading.Lock()
+
+    def request(self, method, path, **kwargs):
+        kwargs.setdefault("timeout", self.timeout)
+        start = time.monotonic()
+        try:
+            response = self.session.request(method, f"{self.base_url}/{path}", **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            self.online = False
+            logger.warning("API unreachable", extra={"fields": {"method": method, "path": path, "error": str(e)}})
+            raise
+        # Any answer, even an error status, means the API is reachable
+        self.online = True
+        self.last_contact = time.monotonic()
+        logger.debug("API request", extra={"fields": {
+            "method": method, "path": path, "status": response.status_code,
+            "ms": round((self.last_contact - start) * 1000, 1)}})
+        return response
+
+    # GET a JSON resource, sending the ETag of the cached copy so the API only
+    # sends the data again when it changed
+    def get_json(self, path, params=None):
+        key = (path, tuple(sorted((params or {}).items())))
+        with self._lock:
+            cached = self.response_cache.get(key)
+        headers = {"If-None-Match": cached[0]} if cached else {}
+
+        response = self.request("GET", path, params=params, headers=headers)
+        if response.status_code == 304 and cached:
+            with self._lock:
+                if key in self.response_cache:
+                    self.response_cache.move_to_end(key)
+            return cached[1]
+        response.raise_for_status()
+
+        data = response.json()
+        etag = response.headers.get("ETag")
+        if etag:
+            with self._lock:
+                self.response_cache[key] = (etag, data)
+                while len(self.response_cache) > RESPONSE_CACHE_SIZE:
+                    self.response_cache.popitem(last=False)
+        return data
+
+    def post_json(self, path, payload):
+        response = self.request("POST", path, json=payload)
+        response.raise_for_status()
+        return response.json()
+
+    def delete_json(self, path, payload):
+        response = self.request("DELETE", path, json=payload)
+        response.raise_for_status()
+        return response.json()
+
+    # Raises like a request when the API cannot be reached. A request that got
+    # an answer in the last heartbeat_seconds counts as a heartbeat.
+    def check_online(self):
+        if self.last_contact is not None and self.online \
+                and time.monotonic() - self.last_contact < self.heartbeat_seconds:
+            return
+        self.request("GET", "is_api_online").raise_for_status()
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,135 @@
+import re
+import threading
+from datetime import date, datetime, timedelta
+from openpyxl import load_workbook
+from dateutil.parser import parse
+
+ISO_DATE = re.compile(r"^(\d{4})-(\d{2})-(\d{2})")
+# Day 0 of Excel's serial date numbers (1900 date system, with the leap year bug)
+EXCEL_EPOCH = date(1899, 12, 30)
+
+
+# Date of an end_date cell. Cells formatted as dates arrive as datetime, the
+# common text and serial number forms are handled directly and anything else
+# goes through dateutil, which is much slower.
+def parse_excel_date(value):
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return EXCEL_EPOCH + timedelta(days=int(value))
+    text = str(value).strip()
+    match = ISO_DATE.match(text)
+    if match:
+        try:
+            return date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+        except ValueError:
+            pass
+    return parse(text).date()
+
+
+# Rows of every sheet after the header, read in openpyxl's read-only mode so
+# the workbook is streamed instead of loaded into memory at once.
+# Yields (client_name, product_name, license_key, end_date_value).
+def iter_excel_rows(workbook):
+    for sheet in workbook.worksheets:
+        for row in sheet.iter_rows(min_row=2, values_only=True):
+            # Verificar se a linha tem quatro colunas, e preencher com None se necessário
+            if len(row) < 4:
+                row = tuple(row) + (None,) * (4 - len(row))
+            yield row[:4]
+
+
+# Number of data rows according to the sheet dimensions, None when a sheet
+# does not record them
+def count_excel_rows(workbook):
+    total = 0
+    for sheet in workbook.worksheets:
+        if sheet.max_row is None:
+            return None
+        total += max(sheet.max_row - 1, 0)
+    return total
+
+
+# Imports a workbook through the bulk endpoints. run() is meant for a worker
+# thread; the GUI reads the counters to show progress and calls cancel().
+class ExcelImportJob:
+    def __init__(self, file_path, post_bulk, chunk_size=500):
+        self.file_path = file_path
+        self.post_bulk = post_bulk
+        self.chunk_size = chunk_size
+
+        self.total_rows = None
+        self.rows_read = 0
+        self.imported = 0
+        self.products_added = 0
+        self.invalid_dates = []
+        self.error = None
+        self.done = False
+        self._cancelled = threading.Event()
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def run(self):
+        try:
+            self._import()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+
+    def _import(self):
+        workbook = load_workbook(filename=self.file_path, read_only=True, data_only=True)
+        try:
+            self.total_rows = count_excel_rows(workbook)
+            new_products = set()
+            chunk = []
+
+            for client_name, product_name, license_key, end_date_value in iter_excel_rows(workbook):
+                if self.cancelled:
+                    return
+                self.rows_read += 1
+
+                if not client_name or not product_name or not end_date_value:
+                    continue
+
+                try:
+                    end_date = parse_excel_date(end_date_value)
+                except (ValueError, TypeError, OverflowError):
+                    self.invalid_dates.append(end_date_value)
+                    continue
+
+                chunk.append({
+                    "client_name": client_name,
+                    "product_name": product_name,
+                    "end_date": end_date.isoformat(),
+                    "license_key": license_key
+                })
+                new_products.add(product_name)
+
+                if len(chunk) >= self.chunk_size:
+                    self._send_subscriptions(chunk)
+                    chunk = []
+
+            if chunk:
+                self._send_subscriptions(chunk)
+        finally:
+            workbook.close()
+
+        # Products that already exist are reported per item and ignored
+        new_products = sorted(new_products)
+        for start in range(0, len(new_products), self.chunk_size):
+            if self.cancelled:
+                return
+            results = self.post_bulk("add_products_bulk", {"product_names": new_products[start:start + self.chunk_size]})
+            self.products_added += sum(1 for result in results if result["status"] == 200)
+
+    def _send_subscriptions(self, chunk):
+        results = self.post_bulk("add_subscriptions_bulk", {"subscriptions": chunk})
+        self.imported += sum(1 for result in results if result["status"] == 200)
@@ -3,10 +3,41 @@ from tkinter import ttk, messagebox, simpledialog, filedialog
 from datetime import datetime, date
 import requests
 import configparser
+import logging
 import os
 import sys
-from openpyxl import load_workbook
-from dateutil.parser import parse
+import threading
+import queue
+from concurrent.futures import ThreadPoolExecutor
+from ExcelImport import ExcelImportJob
+from ApiClient import ApiClient
+from VirtualTreeview import VirtualTreeview
+
+# The logging setup is shared with the API and the checker, one directory up
+# (a frozen build bundles it)
+if not getattr(sys, 'frozen', False):
+    sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from SubscriptionLogging import configure_logging
+
+logger = logging.getLogger("subscription.gui")
+
+# Columns of the subscriptions window and the field each one sorts by
+SUBSCRIPTION_COLUMNS = (("Nome do cliente", "client_name"), ("Nome do produto", "product_name"),
+                        ("Data de términio", "end_date"), ("License Key", "license_key"), ("Index", "index"))
+
+
+# Sort key of a subscription for a column: names case-insensitive, end dates
+# as dates (unparseable ones last), the index breaking ties
+def subscription_sort_key(sub, field):
+    if field == "index":
+        return (0, "", sub["index"])
+    value = sub.get(field)
+    if field == "end_date":
+        try:
+            return (0, datetime.strptime(str(value), "%Y-%m-%d").date(), sub["index"])
+        except ValueError:
+            return (1, str(value or ""), sub["index"])
+    return (0, str(value or "").lower(), sub["index"])
 
 class SubscriptionFormApp:
     def __init__(self, master):
@@ -26,9 +57,35 @@ class SubscriptionFormApp:
 
         self.config = configparser.ConfigParser()
         self.config.read(config_file_path)
+        # The form usually runs without a console, its log goes to a file
+        configure_logging(self.config, "gui", os.path.join(self.script_dir, "subscription_form.log"))
 
         self.host = self.config.get("Form", "host")
         self.port = self.config.getint("Form", "port")
+        # Rows sent per request when importing from Excel
+        self.import_chunk_size = self.config.getint("Form", "import_chunk_size", fallback=500)
+        # Most products listed for a product search
+        self.product_search_limit = self.config.getint("Form", "product_search_limit", fallback=100)
+        # Rows fetched per request by the subscriptions window
+        self.page_size = self.config.getint("Form", "page_size", fallback=200)
+
+        # Search term and sort order of the rows in the subscriptions window
+        self.subscription_search = ""
+        self.subscription_sort = "index"
+        self.search_after = None
+
+        # One keep-alive session for every request to the API
+        self.api = ApiClient(self.host, self.port,
+                             timeout=self.config.getfloat("Form", "timeout_seconds", fallback=10),
+                             retries=self.config.getint("Form", "retries", fallback=3),
+                             heartbeat_seconds=self.config.getfloat("Form", "heartbeat_seconds", fallback=30))
+        # API calls run on worker threads, their results are handed back to
+        # the Tk thread through a queue drained with after()
+        self.executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="api")
+        self.results = queue.Queue()
+        self.latest_requests = {}   # key -> (generation, future) of the latest request
+        self.pending_requests = 0
+        self.polling = False
 
         self.form_frame = ttk.Frame(master, padding="20")
         self.form_frame.grid(row=0, column=0, sticky="nsew")
@@ -59,9 +116,6 @@ class SubscriptionFormApp:
         self.product_listbox = tk.Listbox(self.form_frame, selectmode=tk.SINGLE)
         self.product_listbox.grid(row=5, column=0, columnspan=3, padx=(0, 10), pady=5, sticky="nsew")
         self.product_listbox.bind("<<ListboxSelect>>", self.on_product_select)
-        self.update_product_list()
-
-        self.product_listbox.selection_clear(0, tk.END)
 
         ttk.Label(self.form_frame, text="Novo Produto:").grid(row=6, column=0, sticky="w")
         self.new_product_entry = ttk.Entry(self.form_frame)
@@ -92,28 +146,114 @@ class SubscriptionFormApp:
         self.import_button = ttk.Button(self.buttons_frame, text="Importar do Excel", command=self.import_from_excel)
         self.import_button.grid(row=0, column=4, pady=5, padx=(0, 5), sticky="ew")
 
-        self.check_api_status()
+        self.status_label = ttk.Label(self.buttons_frame, text="")
+        self.status_label.grid(row=1, column=0, columnspan=5, sticky="w")
 
-    def check_api_status(self):
-        try:
-            api_url = f"http://{self.host}:{self.port}/is_api_online"
-            response = requests.get(api_url)
-            response.raise_for_status()
-        except requests.ConnectionError:
+        # The window is shown right away and the products fill in when they
+        # arrive. The first request doubles as the API check.
+        self.update_product_list(on_error=self.api_unavailable)
+
+    # The buttons stay disabled until the API answers again: a heartbeat is
+    # sent every heartbeat_seconds, unless another request (a product search)
+    # got an answer in the meantime
+    def api_unavailable(self, error):
+        self.show_request_error("Falha ao conectar à API", error)
+        self.disable_buttons()
+        self.schedule_api_check()
+
+    def schedule_api_check(self, error=None):
+        self.master.after(int(self.api.heartbeat_seconds * 1000), self.check_api)
+
+    def check_api(self):
+        self.run_async("is_api_online", self.api.check_online, self.api_available,
+                       on_error=self.schedule_api_check)
+
+    def api_available(self, result):
+        self.enable_buttons()
+        self.update_product_list()
+
+    def get_json(self, path, params=None):
+        return self.api.get_json(path, params)
+
+    # Run work() on a worker thread, then on_success(result) or on_error(exception)
+    # on the Tk thread. Reads with the same key coalesce: only the latest one
+    # is answered, older ones are cancelled or their results dropped. Writes
+    # pass coalesce=False, each of them is sent and answered.
+    def run_async(self, key, work, on_success, error_message="Falha na requisição", on_error=None, coalesce=True):
+        generation = None
+        if coalesce:
+            generation, previous = self.latest_requests.get(key, (0, None))
+            if previous is not None and previous.cancel():
+                self.pending_requests -= 1
+            generation += 1
+
+        def run():
+            try:
+                result = (True, work())
+            except Exception as e:
+                result = (False, e)
+            self.results.put((key, generation, result, on_success, on_error, error_message))
+
+        if not self.polling:
+            self.polling = True
+            self.master.after(50, self.process_results)
+        self.pending_requests += 1
+        future = self.executor.submit(run)
+        if coalesce:
+            self.latest_requests[key] = (generation, future)
+        self.show_loading()
+
+    def process_results(self):
+        while True:
+            try:
+                key, generation, (ok, value), on_success, on_error, error_message = self.results.get_nowait()
+            except queue.Empty:
+                break
+            self.pending_requests -= 1
+            if generation is not None and self.latest_requests[key][0] != generation:
+                continue
+            if ok:
+                on_success(value)
+                continue
+            logger.warning("Request failed", exc_info=value, extra={"fields": {"request": key}})
+            if on_error is not None:
+                on_error(value)
+            else:
+                self.show_request_error(error_message, value)
+        self.show_loading()
+        if self.pending_requests:
+            self.master.after(50, self.process_results)
+        else:
+            self.polling = False
+
+    def show_loading(self):
+        if self.pending_requests:
+            self.status_label.config(text="Carregando...")
+            self.master.config(cursor="watch")
+        else:
+            self.status_label.config(text="")
+            self.master.config(cursor="")
+
+    def show_request_error(self, message, error):
+        if isinstance(error, requests.ConnectionError):
             self.handle_error("Erro", "Falha ao conectar à API: Problema de conexão.")
-            self.disable_buttons()
-        except requests.RequestException as e:
-            self.handle_error("Erro", f"Falha ao conectar à API: {e}")
-            self.disable_buttons()
+        else:
+            self.handle_error("Erro", f"{message}: {error}")
 
     def disable_buttons(self):
-        self.add_button.config(state=tk.DISABLED)
-        self.view_button.config(state=tk.DISABLED)
-        self.delete_button.config(state=tk.DISABLED)
-        self.renew_button.config(state=tk.DISABLED)
-        self.add_product_button.config(state=tk.DISABLED)
-        self.delete_product_button.config(state=tk.DISABLED)
-        self.import_button.config(state=tk.DISABLED)
+        self.set_buttons_state(tk.DISABLED)
+
+    def enable_buttons(self):
+        self.set_buttons_state(tk.NORMAL)
+
+    def set_buttons_state(self, state):
+        self.add_button.config(state=state)
+        self.view_button.config(state=state)
+        self.delete_button.config(state=state)
+        self.renew_button.config(state=state)
+        self.add_product_button.config(state=state)
+        self.delete_product_button.config(state=state)
+        self.import_button.config(state=state)
 
     def add_subscription(self):
         client_name = self.client_name_entry.get().strip()
@@ -126,256 +266,281 @@ class SubscriptionFormApp:
             return
 
         try:
-            self.check_api_status()
-
             end_date = datetime.strptime(end_date_str, "%Y-%m-%d").date()
             if end_date < datetime.today().date():
                 raise ValueError("A data de término não pode estar no passado.")
-
-            api_url = f"http://{self.host}:{self.port}/add_subscription"
-            new_subscription = {
-                "client_name": client_name,
-                "product_name": selected_product,
-                "end_date": end_date_str,
-                "license_key": license_key
-            }
-            response = requests.post(api_url, json=new_subscription)
-            response.raise_for_status()
-            messagebox.showinfo("Sucesso", "Assinatura adicionada com sucesso.")
         except ValueError as e:
             self.handle_error("Erro", str(e))
-        except requests.ConnectionError:
-            self.handle_error("Erro", "Falha ao conectar à API: Problema de conexão.")
-        except requests.RequestException as e:
-            self.handle_error("Erro", f"Falha ao adicionar assinatura: {e}")
+            return
+
+        new_subscription = {
+            "client_name": client_name,
+            "product_name": selected_product,
+            "end_date": end_date.isoformat(),
+            "license_key": license_key
+        }
+        self.run_async("add_subscription", lambda: self.api.post_json("add_subscription", new_subscription),
+                       lambda result: messagebox.showinfo("Sucesso", "Assinatura adicionada com sucesso."),
+                       "Falha ao adicionar assinatura", coalesce=False)
 
-    
     def view_subscriptions(self):
-        try:
-            self.check_api_status()
+        self.subscription_search = ""
+        self.subscription_sort = "index"
+        self.run_async("subscriptions", lambda: self.fetch_subscriptions(0), self.open_subscriptions_window,
+                       "Falha ao buscar assinaturas")
+
+    # The window opens with the first page, further pages are fetched as the
+    # list is scrolled
+    def open_subscriptions_window(self, first_page):
+        if not first_page["total"]:
+            messagebox.showinfo("Sem Assinaturas", "Nenhuma assinatura encontrada.")
+            return
 
-            api_url = f"http://{self.host}:{self.port}/view_subscriptions"
-            response = requests.get(api_url)
-            response.raise_for_status()
+        self.view_window = tk.Toplevel(self.master)
+        self.view_window.title("Visualizar Assinaturas")
 
-            subscriptions = response.json()
+        screen_width = self.view_window.winfo_screenwidth()
+        screen_height = self.view_window.winfo_screenheight()
+        x = (screen_width - self.view_window.winfo_reqwidth()) // 2
+        y = (screen_height - self.view_window.winfo_reqheight()) // 2
+        self.view_window.geometry("+{}+{}".format(x, y))
 
-            if subscriptions:
-                self.view_window = tk.Toplevel(self.master)
-                self.view_window.title("Visualizar Assinaturas")
+        search_frame = ttk.Frame(self.view_window)
+        search_frame.grid(row=0, column=0, columnspan=5, padx=10, pady=5, sticky="ew")
 
-                screen_width = self.view_window.winfo_screenwidth()
-                screen_height = self.view_window.winfo_screenheight()
-                x = (screen_width - self.view_window.winfo_reqwidth()) // 2
-                y = (screen_height - self.view_window.winfo_reqheight()) // 2
-                self.view_window.geometry("+{}+{}".format(x, y))
+        # Searches as you type, once typing pauses
+        self.subscription_search_var = tk.StringVar(self.view_window)
+        self.subscription_search_var.trace_add("write", self.on_search_typed)
+        search_entry = ttk.Entry(search_frame, textvariable=self.subscription_search_var)
+        search_entry.grid(row=0, column=0, padx=(0, 5), sticky="ew")
 
-                search_frame = ttk.Frame(self.view_window)
-                search_frame.grid(row=0, column=0, columnspan=5, padx=10, pady=5, sticky="ew")
+        search_button = ttk.Button(search_frame, text="Procurar", command=self.filter_subscriptions)
+        search_button.grid(row=0, column=1, padx=(5, 0))
 
-                search_entry = ttk.Entry(search_frame, textvariable=self.search_var)
-                search_entry.grid(row=0, column=0, padx=(0, 5), sticky="ew")
+        sort_button = ttk.Button(search_frame, text="Ordenar Alfabeticamente", command=self.sort_subscriptions)
+        sort_button.grid(row=0, column=2, padx=(5, 0))
 
-                search_button = ttk.Button(search_frame, text="Procurar", command=self.filter_subscriptions)
-                search_button.grid(row=0, column=1, padx=(5, 0))
+        restore_button = ttk.Button(search_frame, text="Restaurar Ordem Original", command=self.restore_subscriptions)
+        restore_button.grid(row=0, column=3, padx=(5, 0))
 
-                sort_button = ttk.Button(search_frame, text="Ordenar Alfabeticamente", command=self.sort_subscriptions)
-                sort_button.grid(row=0, column=2, padx=(5, 0))
+        view_frame = ttk.Frame(self.view_window, padding="10")
+        view_frame.grid(row=1, column=0, columnspan=5, sticky="nsew")
 
-                restore_button = ttk.Button(search_frame, text="Restaurar Ordem Original", command=self.restore_subscriptions)
-                restore_button.grid(row=0, column=3, padx=(5, 0))
+        view_frame.columnconfigure(0, weight=1)
+        view_frame.rowconfigure(0, weight=1)
 
-                view_frame = ttk.Frame(self.view_window, padding="10")
-                view_frame.grid(row=1, column=0, columnspan=5, sticky="nsew")
+        tree_columns = tuple(heading for heading, _ in SUBSCRIPTION_COLUMNS)
+        self.subscription_view = VirtualTreeview(view_frame, tree_columns, self.subscription_values,
+                                                 self.load_subscription_page, page_size=self.page_size,
+                                                 row_id=lambda sub: sub["index"])
+        self.subscription_view.grid(row=0, column=0, sticky="nsew")
+        self.tree = self.subscription_view.tree
+        for heading, field in SUBSCRIPTION_COLUMNS:
+            self.tree.heading(heading, command=lambda field=field: self.sort_by_column(field))
+        self.update_sort_headings()
 
-                view_frame.columnconfigure(0, weight=1)
-                view_frame.rowconfigure(0, weight=1)
+        self.subscription_view.reset(first_page["subscriptions"], first_page["total"])
 
-                tree_columns = ("Nome do cliente", "Nome do produto", "Data de términio", "License Key", "Index")
-                self.tree = ttk.Treeview(view_frame, columns=tree_columns, show="headings")
 
-                for col in tree_columns:
-                    self.tree.heading(col, text=col)
-                    self.tree.column(col, anchor="center")
+    # One page of the current search and sort order. Filtering and sorting run
+    # on the API, only the rows of the page are sent back.
+    def fetch_subscriptions(self, page):
+        params = {"q": self.subscription_search, "sort": self.subscription_sort,
+                  "limit": self.page_size, "offset": page * self.page_size}
+        return self.get_json("view_subscriptions", params)
 
-                vsb = ttk.Scrollbar(view_frame, orient="vertical", command=self.tree.yview)
-                self.tree.configure(yscroll=vsb.set)
-                self.tree.grid(row=0, column=0, sticky="nsew")
-                vsb.grid(row=0, column=1, sticky="ns")
+    def subscription_values(self, sub):
+        return (sub["client_name"], sub["product_name"], sub["end_date"], sub.get("license_key"), sub["index"])
 
-                self.filtered_subscriptions = subscriptions
-                for sub in subscriptions:
-                    values = (sub["client_name"], sub["product_name"], sub["end_date"], sub["license_key"], sub["index"])
-                    self.tree.insert("", "end", values=values)
+    def load_subscription_page(self, page, on_loaded, on_failed):
+        def on_error(error):
+            on_failed()
+            self.show_request_error("Falha ao buscar assinaturas", error)
 
-            else:
-                messagebox.showinfo("Sem Assinaturas", "Nenhuma assinatura encontrada.")
+        self.run_async(("subscriptions", page), lambda: self.fetch_subscriptions(page),
+                       lambda result: on_loaded(result["subscriptions"], result["total"]), on_error=on_error)
 
-        except requests.ConnectionError:
-            self.handle_error("Erro", "Falha ao conectar à API: Problema de conexão.")
-        except requests.RequestException as e:
-            self.handle_error("Erro", f"Falha ao buscar assinaturas: {e}")
+    def on_search_typed(self, *args):
+        if self.search_after is not None:
+            self.master.after_cancel(self.search_after)
+        self.search_after = self.master.after(300, self.search_subscriptions)
 
+    # A typed term that only narrows the current one is applied to the rows
+    # already loaded, when all of them are; anything else asks the API again
+    def search_subscriptions(self):
+        self.search_after = None
+        if not self.view_window.winfo_exists():
+            return
+        search_term = self.subscription_search_var.get().strip()
+        if search_term == self.subscription_search:
+            return
+
+        rows = self.subscription_view.loaded_rows()
+        if rows is not None and self.subscription_search.lower() in search_term.lower():
+            term = search_term.lower()
+            self.subscription_search = search_term
+            self.subscription_view.show_rows([sub for sub in rows
+                                              if term in str(sub.get("client_name") or "").lower()
+                                              or term in str(sub.get("product_name") or "").lower()])
+            self.sort_loaded_rows()
+            return
+        self.refresh_subscriptions()
+
+    # Clicking a heading sorts by its column, clicking it again reverses the
+    # order. Rows that are all in memory are sorted here, otherwise the API
+    # sorts and the pages are fetched again.
+    def sort_by_column(self, field, descending=None):
+        if descending is None:
+            descending = self.subscription_sort == field
+        self.subscription_sort = ("-" if descending else "") + field
+        rows = self.subscription_view.loaded_rows()
+        if rows is not None:
+            if self.subscription_view.rows is None:
+                self.subscription_view.show_rows(rows)
+            self.sort_loaded_rows()
+        else:
+            self.subscription_view.reset()
+        self.update_sort_headings()
+
+    def sort_loaded_rows(self):
+        field = self.subscription_sort.lstrip("-")
+        self.subscription_view.sort_rows(field, self.subscription_sort.startswith("-"),
+                                         lambda sub: subscription_sort_key(sub, field))
+
+    def update_sort_headings(self):
+        for heading, field in SUBSCRIPTION_COLUMNS:
+            text = heading
+            if self.subscription_sort == field:
+                text += " ▲"
+            elif self.subscription_sort == "-" + field:
+                text += " ▼"
+            self.tree.heading(heading, text=text)
+
+    def refresh_subscriptions(self):
+        self.subscription_search = self.subscription_search_var.get().strip()
+        self.subscription_view.reset()
 
     def filter_subscriptions(self):
-        search_term = self.search_var.get().strip().lower()
-        self.tree.delete(*self.tree.get_children())
-        filtered_subscriptions = [
-            sub for sub in self.filtered_subscriptions
-            if search_term in sub["client_name"].lower() or search_term in sub["product_name"].lower()
-        ]
-        for sub in filtered_subscriptions:
-            values = (sub["client_name"], sub["product_name"], sub["end_date"], sub["license_key"], sub['index'])
-            self.tree.insert("", "end", values=values)
+        self.refresh_subscriptions()
 
     def sort_subscriptions(self):
-        sorted_subscriptions = sorted(self.filtered_subscriptions, key=lambda x: x["client_name"].lower())
-        self.tree.delete(*self.tree.get_children())
-        for sub in sorted_subscriptions:
-            values = (sub["client_name"], sub["product_name"], sub["end_date"], sub["license_key"], sub['index'])
-            self.tree.insert("", "end", values=values)
+        self.sort_by_column("client_name", descending=False)
 
     def restore_subscriptions(self):
-        self.tree.delete(*self.tree.get_children())
-        for sub in self.filtered_subscriptions:
-            values = (sub["client_name"], sub["product_name"], sub["end_date"], sub["license_key"], sub['index'])
-            self.tree.insert("", "end", values=values)
+        self.sort_by_column("index", descending=False)
 
     def delete_subscription(self):
-         try:
-             self.check_api_status()
-
-             selected_index = simpledialog.askinteger("Input", "Index da Assinatura:")
-             if selected_index is None:
-                 return
-
-             api_url = f"http://{self.host}:{self.port}/delete_subscription"
-             payload = {
-                 "index": selected_index
-             }
-             response = requests.delete(api_url, json=payload)
-             response.raise_for_status()
-             messagebox.showinfo("Sucesso", "Assinatura excluída com sucesso.")
-         except requests.ConnectionError:
-             self.handle_error("Erro", "Falha ao conectar à API: Problema de conexão.")
-         except requests.RequestException as e:
-             self.handle_error("Erro", f"Falha ao excluir assinatura: {e}")
-
-    def renew_subscription(self):
-        try:
-            self.check_api_status()
+        selected_index = simpledialog.askinteger("Input", "Index da Assinatura:")
+        if selected_index is None:
+            return
 
-            index = simpledialog.askinteger("Renew Subscription", "Enter the index of the subscription to renew:")
-            if index is None:
-                return
+        payload = {
+            "index": selected_index
+        }
+        self.run_async("delete_subscription", lambda: self.api.delete_json("delete_subscription", payload),
+                       lambda result: messagebox.showinfo("Sucesso", "Assinatura excluída com sucesso."),
+                       "Falha ao excluir assinatura", coalesce=False)
 
-            new_end_date_str = simpledialog.askstring("Renew Subscription", "Enter the new end date (YYYY-MM-DD):")
-            if not new_end_date_str:
-                return
+    def renew_subscription(self):
+        index = simpledialog.askinteger("Renew Subscription", "Enter the index of the subscription to renew:")
+        if index is None:
+            return
 
-            # Validate and parse the new end date
-            try:
-                new_end_date = datetime.strptime(new_end_date_str, "%Y-%m-%d").date()
-            except ValueError:
-                self.handle_error("Error", "Invalid date format. Please use YYYY-MM-DD.")
-                return
+        new_end_date_str = simpledialog.askstring("Renew Subscription", "Enter the new end date (YYYY-MM-DD):")
+        if not new_end_date_str:
+            return
 
-            api_url = f"http://{self.host}:{self.port}/renew_subscription"
-            renewal_data = {
-                "index": index,
-                "new_end_date": new_end_date_str
-            }
-            response = requests.post(api_url, json=renewal_data)
-            response.raise_for_status()
+        # Validate and parse the new end date
+        try:
+            new_end_date = datetime.strptime(new_end_date_str, "%Y-%m-%d").date()
+        except ValueError:
+            self.handle_error("Error", "Invalid date format. Please use YYYY-MM-DD.")
+            return
 
-            messagebox.showinfo("Success", "Subscription renewed successfully.")
-        except requests.RequestException as e:
-            self.handle_error("Error", str(e))
+        renewal_data = {
+            "index": index,
+            "new_end_date": new_end_date.isoformat()
+        }
+        self.run_async("renew_subscription", lambda: self.api.post_json("renew_subscription", renewal_data),
+                       lambda result: messagebox.showinfo("Success", "Subscription renewed successfully."),
+                       "Falha ao renovar assinatura", coalesce=False)
 
 
 
+    # The workbook is streamed and uploaded by a worker thread, the window
+    # only polls its progress, so large imports do not freeze the form
     def import_from_excel(self):
         file_path = filedialog.askopenfilename(filetypes=[("Excel files", "*.xlsx"), ("All files", "*.*")])
 
         if not file_path:
             return
 
-        try:
-            self.check_api_status()
-
-            workbook = load_workbook(filename=file_path, data_only=True)
-
-            new_products = set()  # Use a set to store new products to avoid duplicates
-
-            for sheet in workbook.worksheets:
-                for row in sheet.iter_rows(min_row=2, values_only=True):
-                    # Verificar se a linha tem quatro colunas, e preencher com None se necessário
-                    if len(row) < 4:
-                        row = list(row) + [None] * (4 - len(row))
-                    elif len(row) > 4:
-                        row = row[:4]
-
-                    client_name, product_name, license_key, end_date_str = row
-
-                    if not client_name or not product_name or not end_date_str:
-                        continue
-
-                    try:
-                        # Analisar a data e garantir que apenas a parte da data seja extraída
-                        end_date = parse(str(end_date_str)).date()
-                    except (ValueError, TypeError):
-                        self.handle_error("Erro", f"Data inválida: {end_date_str}")
-                        continue
-
-                    api_url = f"http://{self.host}:{self.port}/add_subscription"
-                    new_subscription = {
-                        "client_name": client_name,
-                        "product_name": product_name,
-                        "end_date": end_date.isoformat(),
-                        "license_key": license_key
-                    }
-                    response = requests.post(api_url, json=new_subscription)
-                    response.raise_for_status()
-
-                    # Add product to the set of new products
-                    new_products.add(product_name)
-
-            # Update the product list with new products
-            if new_products:
-                for product_name in new_products:
-                    try:
-                        self.check_api_status()
-
-                        api_url = f"http://{self.host}:{self.port}/add_product"
-                        product_data = {"product_name": product_name}
-                        response = requests.post(api_url, json=product_data)
-                        
-                        # Check if product already exists
-                        if response.status_code == 400:
-                            error_msg = response.json().get("error")
-                            if error_msg and "already exists" in error_msg.lower():
-                                continue  # Ignore if product already exists
-
-                        response.raise_for_status()
-
-                    except requests.ConnectionError:
-                        self.handle_error("Erro", "Falha ao conectar à API: Problema de conexão.")
-                    except requests.RequestException as e:
-                        self.handle_error("Erro", f"Falha ao adicionar produto '{product_name}': {e}")
-
-                messagebox.showinfo("Sucesso", "Produtos adicionados com sucesso.")
-                self.update_product_list()  # Update the product list in the UI
-
-            messagebox.showinfo("Sucesso", "Assinaturas importadas com sucesso do Excel.")
-        except ValueError as e:
-            self.handle_error("Erro", f"Erro ao processar o arquivo Excel: {e}")
-        except requests.ConnectionError:
-            self.handle_error("Erro", "Falha ao conectar à API: Problema de conexão.")
-        except requests.RequestException as e:
-            self.handle_error("Erro", f"Falha ao importar assinaturas: {e}")
+        self.import_job = ExcelImportJob(file_path, self.post_bulk, self.import_chunk_size)
+
+        self.import_window = tk.Toplevel(self.master)
+        self.import_window.title("Importar do Excel")
+        self.import_window.protocol("WM_DELETE_WINDOW", self.import_job.cancel)
+
+        import_frame = ttk.Frame(self.import_window, padding="20")
+        import_frame.grid(row=0, column=0, sticky="nsew")
 
+        self.import_label = ttk.Label(import_frame, text="Abrindo arquivo...")
+        self.import_label.grid(row=0, column=0, sticky="w")
 
+        self.import_progress = ttk.Progressbar(import_frame, length=300, mode="indeterminate")
+        self.import_progress.grid(row=1, column=0, pady=10, sticky="ew")
+        self.import_progress.start()
 
+        ttk.Button(import_frame, text="Cancelar", command=self.import_job.cancel).grid(row=2, column=0)
+
+        self.import_button.config(state=tk.DISABLED)
+        threading.Thread(target=self.import_job.run, daemon=True).start()
+        self.master.after(100, self.poll_import)
+
+    def poll_import(self):
+        job = self.import_job
+        if not job.done:
+            if job.cancelled:
+                self.import_label.config(text="Cancelando...")
+            elif job.total_rows:
+                if str(self.import_progress.cget("mode")) != "determinate":
+                    self.import_progress.stop()
+                    self.import_progress.config(mode="determinate", maximum=job.total_rows)
+                self.import_progress.config(value=job.rows_read)
+                self.import_label.config(text=f"{job.rows_read} de {job.total_rows} linhas, {job.imported} importadas")
+            else:
+                self.import_label.config(text=f"{job.rows_read} linhas, {job.imported} importadas")
+            self.master.after(100, self.poll_import)
+            return
+
+        self.import_window.destroy()
+        self.import_button.config(state=tk.NORMAL)
+        logger.info("Excel import finished", exc_info=job.error, extra={"fields": {
+            "rows_read": job.rows_read, "imported": job.imported, "products_added": job.products_added,
+            "invalid_dates": len(job.invalid_dates), "cancelled": job.cancelled}})
+
+        if job.invalid_dates:
+            shown = ", ".join(str(value) for value in job.invalid_dates[:10])
+            more = f" (e mais {len(job.invalid_dates) - 10})" if len(job.invalid_dates) > 10 else ""
+            self.handle_error("Erro", f"Datas inválidas ignoradas: {shown}{more}")
+
+        if isinstance(job.error, requests.ConnectionError):
+            self.handle_error("Erro", "Falha ao conectar à API: Problema de conexão.")
+        elif isinstance(job.error, requests.RequestException):
+            self.handle_error("Erro", f"Falha ao importar assinaturas: {job.error}")
+        elif job.error is not None:
+            self.handle_error("Erro", f"Erro ao processar o arquivo Excel: {job.error}")
+        elif job.cancelled:
+            messagebox.showinfo("Cancelado", f"Importação cancelada, {job.imported} assinaturas já foram importadas.")
+        else:
+            messagebox.showinfo("Sucesso", f"{job.imported} assinaturas importadas com sucesso do Excel.")
+
+        if job.products_added:
+            self.update_product_list()  # Update the product list in the UI
+
+    # Send one chunk of an import to a bulk endpoint
+    def post_bulk(self, path, payload):
+        return self.api.post_json(path, payload)["results"]
 
     def handle_error(self, title, message):
         messagebox.showerror(title, message)
@@ -387,21 +552,14 @@ class SubscriptionFormApp:
             self.handle_error("Erro", "Nome do produto não pode estar vazio.")
             return
 
-        try:
-            self.check_api_status()
+        product_data = {"product_name": new_product}
+        self.run_async("add_product", lambda: self.api.post_json("add_product", product_data),
+                       self.on_product_added, "Falha ao adicionar produto", coalesce=False)
 
-            api_url = f"http://{self.host}:{self.port}/add_product"
-            product_data = {"product_name": new_product}
-            response = requests.post(api_url, json=product_data)
-            response.raise_for_status()
-
-            messagebox.showinfo("Sucesso", "Produto adicionado com sucesso.")
-            self.update_product_list()
-            self.new_product_entry.delete(0, tk.END)
-        except requests.ConnectionError:
-            self.handle_error("Erro", "Falha ao conectar à API: Problema de conexão.")
-        except requests.RequestException as e:
-            self.handle_error("Erro", f"Falha ao adicionar produto: {e}")
+    def on_product_added(self, result):
+        messagebox.showinfo("Sucesso", "Produto adicionado com sucesso.")
+        self.update_product_list()
+        self.new_product_entry.delete(0, tk.END)
 
     def delete_product(self):
         selected_product = self.product_listbox.get(tk.ACTIVE)
@@ -410,20 +568,13 @@ class SubscriptionFormApp:
             self.handle_error("Erro", "Selecione um produto para excluir.")
             return
 
-        try:
-            self.check_api_status()
-
-            api_url = f"http://{self.host}:{self.port}/delete_product"
-            product_data = {"product_name": selected_product}
-            response = requests.delete(api_url, json=product_data)
-            response.raise_for_status()
+        product_data = {"product_name": selected_product}
+        self.run_async("delete_product", lambda: self.api.delete_json("delete_product", product_data),
+                       self.on_product_deleted, "Falha ao excluir produto", coalesce=False)
 
-            messagebox.showinfo("Sucesso", "Produto excluído com sucesso.")
-            self.update_product_list()
-        except requests.ConnectionError:
-            self.handle_error("Erro", "Falha ao conectar à API: Problema de conexão.")
-        except requests.RequestException as e:
-            self.handle_error("Erro", f"Falha ao excluir produto: {e}")
+    def on_product_deleted(self, result):
+        messagebox.showinfo("Sucesso", "Produto excluído com sucesso.")
+        self.update_product_list()
 
 
     def on_product_select(self, event):
@@ -432,55 +583,38 @@ class SubscriptionFormApp:
             self.new_product_entry.delete(0, tk.END)
             self.new_product_entry.insert(0, selected_product)
 
+    # Searches and reloads of the product list share one key, so only the
+    # latest of them fills the list
     def filter_products(self):
         search_term = self.search_var.get().strip().lower()
-        self.product_listbox.delete(0, tk.END)
-        try:
-            self.check_api_status()
-
-            api_url = f"http://{self.host}:{self.port}/get_products"
-            response = requests.get(api_url)
-            response.raise_for_status()
-
-            products = response.json()
-
-            # Filter products based on search term
-            filtered_products = [product for product in products if search_term in product.lower()]
+        # The API does the matching and only returns the best matches
+        params = {"q": search_term, "limit": self.product_search_limit}
+        self.run_async("products", lambda: self.get_json("search_products", params), self.show_products,
+                       "Falha ao buscar produtos")
 
-            for product in filtered_products:
-                self.product_listbox.insert(tk.END, product)
-
-        except requests.ConnectionError:
-            self.handle_error("Erro", "Falha ao conectar à API: Problema de conexão.")
-        except requests.RequestException as e:
-            self.handle_error("Erro", f"Falha ao buscar produtos: {e}")
-
-    def update_product_list(self):
+    def update_product_list(self, on_error=None):
         self.search_var.set("")  # Reset the search field
-        self.product_listbox.delete(0, tk.END)
-        try:
-            self.check_api_status()
-
-            api_url = f"http://{self.host}:{self.port}/get_products"
-            response = requests.get(api_url)
-            response.raise_for_status()
+        self.run_async("products", lambda: self.get_json("get_products"), self.show_products,
+                       "Falha ao buscar produtos", on_error)
 
-            products = response.json()
-
-            for product in products:
-                self.product_listbox.insert(tk.END, product)
-
-        except requests.ConnectionError:
-            self.handle_error("Erro", "Falha ao conectar à API: Problema de conexão.")
-        except requests.RequestException as e:
-            self.handle_error("Erro", f"Falha ao buscar produtos: {e}")
+    def show_products(self, products):
+        self.product_listbox.delete(0, tk.END)
+        for product in products:
+            self.product_listbox.insert(tk.END, product)
+        self.product_listbox.selection_clear(0, tk.END)
 
     def create_config_file(self, config_file_path):
         config = configparser.ConfigParser()
 
         config["Form"] = {
             "host": "localhost",
-            "port": "5000"
+            "port": "5000",
+            "import_chunk_size": "500",
+            "product_search_limit": "100",
+            "timeout_seconds": "10",
+            "retries": "3",
+            "heartbeat_seconds": "30",
+            "page_size": "200"
         }
 
         with open(config_file_path, "w") as config_file:
@@ -0,0 +1,202 @@
+from collections import OrderedDict
+from tkinter import ttk
+
+# Pages kept in memory, the least recently used are dropped beyond this
+MAX_CACHED_PAGES = 50
+
+
+# A Treeview that only holds the rows on screen. The rows of the result live
+# in pages that are loaded on demand through load_page(page, on_loaded,
+# on_failed), where on_loaded(rows, total) receives the page and the size of
+# the whole result. Scrolling gives the same items other values instead of
+# inserting and deleting items, so the cost does not depend on the row count.
+# show_rows() switches to a list that is already in memory, which sort_rows()
+# can then reorder without touching the list itself.
+class VirtualTreeview:
+    def __init__(self, parent, columns, row_values, load_page, height=20, page_size=200, buffer_pages=1,
+                 row_id=id):
+        self.row_values = row_values
+        self.row_id = row_id
+        self.load_page = load_page
+        self.height = height
+        self.page_size = page_size
+        self.buffer_pages = buffer_pages
+
+        self.frame = ttk.Frame(parent)
+        self.frame.columnconfigure(0, weight=1)
+        self.frame.rowconfigure(0, weight=1)
+
+        self.tree = ttk.Treeview(self.frame, columns=columns, show="headings", height=height, selectmode="browse")
+        for col in columns:
+            self.tree.heading(col, text=col)
+            self.tree.column(col, anchor="center")
+        self.scrollbar = ttk.Scrollbar(self.frame, orient="vertical", command=self.on_scroll)
+        self.tree.grid(row=0, column=0, sticky="nsew")
+        self.scrollbar.grid(row=0, column=1, sticky="ns")
+
+        # One item per visible row, reused for whatever row is at that position
+        self.items = [self.tree.insert("", "end", values=()) for _ in range(height)]
+        for sequence in ("<MouseWheel>", "<Button-4>", "<Button-5>"):
+            self.tree.bind(sequence, self.on_mousewheel)
+
+        self.total = 0
+        self.first = 0
+        self.rows = None
+        self.pages = OrderedDict()
+        self.requested = set()
+        # Answers to requests made before the last reset() are ignored
+        self.generation = 0
+
+        # Sort key of each row by field and row id, computed once per row. They
+        # outlive show_rows(), which only shows a part of the same data.
+        self.sort_keys = {}
+        # Ascending order of self.rows by field, as positions in self.rows
+        self.permutations = {}
+        self.order = None
+        self.descending = False
+
+    def grid(self, **kwargs):
+        self.frame.grid(**kwargs)
+
+    # Start over with a new result, loaded page by page from load_page. The
+    # first page can be passed in when the caller already has it.
+    def reset(self, first_page=None, total=0):
+        self.generation += 1
+        self.rows = None
+        self.pages.clear()
+        self.requested.clear()
+        self.sort_keys = {}
+        self.permutations = {}
+        self.order = None
+        self.total = total
+        self.first = 0
+        if first_page is not None:
+            self.pages[0] = first_page
+        else:
+            self.request_page(0)
+        self.render()
+
+    # Show rows that are already in memory
+    def show_rows(self, rows):
+        self.generation += 1
+        self.rows = rows
+        self.pages.clear()
+        self.requested.clear()
+        self.permutations = {}
+        self.order = None
+        self.total = len(rows)
+        self.first = 0
+        self.render()
+
+    # Order the rows in memory by field. Toggling the direction or going back
+    # to a field sorted before reuses its permutation, nothing is sorted again.
+    def sort_rows(self, field, descending, key_function):
+        permutation = self.permutations.get(field)
+        if permutation is None:
+            keys = self.sort_keys.setdefault(field, {})
+            row_keys = []
+            for row in self.rows:
+                row_id = self.row_id(row)
+                key = keys.get(row_id)
+                if key is None:
+                    key = keys[row_id] = key_function(row)
+                row_keys.append(key)
+            permutation = sorted(range(len(self.rows)), key=row_keys.__getitem__)
+            self.permutations[field] = permutation
+        self.order = permutation
+        self.descending = descending
+        self.first = 0
+        self.render()
+
+    # Every row of the current result, or None while some are not loaded
+    def loaded_rows(self):
+        if self.rows is not None:
+            return self.rows
+        page_count = (self.total + self.page_size - 1) // self.page_size
+        if self.requested or any(page not in self.pages for page in range(page_count)):
+            return None
+        return [row for page in range(page_count) for row in self.pages[page]]
+
+    def row(self, position):
+        if self.rows is not None:
+            if self.order is not None:
+                position = self.order[-1 - position] if self.descending else self.order[position]
+            return self.rows[position]
+        page = self.pages.get(position // self.page_size)
+        if page is None or position % self.page_size >= len(page):
+            return None
+        return page[position % self.page_size]
+
+    def render(self):
+        visible = max(min(self.height, self.total - self.first), 0)
+        for slot, item in enumerate(self.items):
+            if slot < visible:
+                row = self.row(self.first + slot)
+                self.tree.item(item, values=self.row_values(row) if row is not None else ("...",))
+                self.tree.move(item, "", slot)
+            else:
+                self.tree.detach(item)
+        if self.total:
+            self.scrollbar.set(self.first / self.total, (self.first + visible) / self.total)
+        else:
+            self.scrollbar.set(0, 1)
+        self.request_visible_pages()
+
+    # Pages on screen plus buffer_pages on each side
+    def request_visible_pages(self):
+        if self.rows is not None or not self.total:
+            return
+        first_page = max(self.first // self.page_size - self.buffer_pages, 0)
+        last_page = min((self.first + self.height - 1) // self.page_size + self.buffer_pages,
+                        (self.total - 1) // self.page_size)
+        for page in range(first_page, last_page + 1):
+            if page in self.pages:
+                self.pages.move_to_end(page)
+            else:
+                self.request_page(page)
+
+    def request_page(self, page):
+        if page in self.requested:
+            return
+        self.requested.add(page)
+        generation = self.generation
+        self.load_page(page,
+                       lambda rows, total: self.on_page_loaded(generation, page, rows, total),
+                       lambda: self.on_page_failed(generation, page))
+
+    def on_page_loaded(self, generation, page, rows, total):
+        # The window may have been closed while the page was on its way
+        if generation != self.generation or not self.tree.winfo_exists():
+            return
+        self.requested.discard(page)
+        self.pages[page] = rows
+        while len(self.pages) > MAX_CACHED_PAGES:
+            self.pages.popitem(last=False)
+        self.total = total
+        self.first = max(min(self.first, self.total - self.height), 0)
+        self.render()
+
+    def on_page_failed(self, generation, page):
+        if generation == self.generation:
+            self.requested.discard(page)
+
+    def scroll_to(self, first):
+        first = max(min(first, self.total - self.height), 0)
+        if first != self.first:
+            self.first = first
+            self.render()
+
+    # Scrollbar commands: ("moveto", fraction) or ("scroll", count, "units" | "pages")
+    def on_scroll(self, *args):
+        if args[0] == "moveto":
+            self.scroll_to(int(float(args[1]) * self.total))
+        elif args[0] == "scroll":
+            step = self.height if args[2] == "pages" else 1
+            self.scroll_to(self.first + int(args[1]) * step)
+
+    def on_mousewheel(self, event):
+        if event.num == 4 or getattr(event, "delta", 0) > 0:
+            self.scroll_to(self.first - 3)
+        else:
+            self.scroll_to(self.first + 3)
+        return "break"
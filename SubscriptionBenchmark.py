@@ -0,0 +1,474 @@
+import argparse
+import configparser
+import json
+import logging
+import os
+import platform
+import random
+import shutil
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import redirect_stdout
+from datetime import date, datetime, timedelta
+import numpy as np
+import requests
+from openpyxl import Workbook
+from NotificationOutbox import Outbox, EmailDispatcher
+from StorageBackend import create_backend, atomic_write
+from SubscriptionStore import SubscriptionStore
+from SubscriptionChecker import SubscriptionChecker, SMTPSession
+from SubscriptionLogging import configure_logging
+
+# Benchmarks the API routes, the checker and the Excel import on generated
+# data sets of several sizes and writes the results as JSON, so runs of two
+# versions can be compared:
+#
+#   python SubscriptionBenchmark.py --sizes 1000,10000,100000,1000000 --output before.json
+#
+# The data is generated in a temporary directory, the data files next to this
+# script are never touched.
+
+if getattr(sys, 'frozen', False):  # if the application is frozen (e.g. pyinstaller)
+    script_dir = os.path.dirname(sys.executable)
+else:
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(script_dir, "SubsForm"))
+from ExcelImport import ExcelImportJob
+
+CLIENT_NAMES = ["Silva", "Santos", "Ferreira", "Pereira", "Oliveira", "Costa", "Rodrigues", "Martins", "Sousa",
+                "Fernandes", "Gonçalves", "Gomes", "Lopes", "Marques", "Alves", "Almeida", "Ribeiro", "Pinto"]
+SENDER_EMAIL = "benchmark@example.com"
+
+
+# Generated data
+
+def product_count(rows):
+    return max(rows // 100, 10)
+
+
+def generate_subscription(rng, index, products, today):
+    return {
+        "client_name": f"{rng.choice(CLIENT_NAMES)} {index}",
+        "product_name": products[rng.randrange(len(products))],
+        # Spread over two years back and two years ahead
+        "end_date": (today + timedelta(days=rng.randint(-730, 730))).isoformat(),
+        "license_key": f"{rng.getrandbits(64):016X}",
+        "index": index,
+        "version": 1,
+    }
+
+
+# subscriptions.json, products.json and store_meta.json with rows subscriptions
+def generate_data(data_dir, rows, seed):
+    rng = random.Random(seed)
+    today = date.today()
+    products = [f"Produto {number}" for number in range(1, product_count(rows) + 1)]
+    subscriptions = [generate_subscription(rng, index, products, today) for index in range(1, rows + 1)]
+    atomic_write(os.path.join(data_dir, "subscriptions.json"), json.dumps(subscriptions))
+    atomic_write(os.path.join(data_dir, "products.json"), json.dumps(products))
+    atomic_write(os.path.join(data_dir, "store_meta.json"), json.dumps({"next_index": rows + 1, "last_seq": 0}))
+
+
+# A workbook laid out like the ones the form imports. Most end dates are date
+# cells, the rest text and serial numbers as found in real sheets, including
+# some that only dateutil can parse.
+def generate_workbook(path, rows, seed):
+    rng = random.Random(seed)
+    today = date.today()
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet("Assinaturas")
+    sheet.append(["Cliente", "Produto", "Licença", "Término"])
+    for number in range(rows):
+        end_date = today + timedelta(days=rng.randint(-730, 730))
+        kind = number % 20
+        if kind < 14:
+            end_value = datetime(end_date.year, end_date.month, end_date.day)
+        elif kind < 18:
+            end_value = end_date.isoformat()
+        elif kind < 19:
+            end_value = (end_date - date(1899, 12, 30)).days
+        else:
+            end_value = end_date.strftime("%d %b %Y")
+        sheet.append([f"{rng.choice(CLIENT_NAMES)} {number}", f"Produto {rng.randint(1, 50)}",
+                      f"{rng.getrandbits(64):016X}", end_value])
+    workbook.save(path)
+
+
+# Statistics
+
+def summarize(latencies, errors, wall_seconds):
+    latencies_ms = np.array(latencies) * 1000
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "throughput_per_second": round(len(latencies) / wall_seconds, 1) if wall_seconds else None,
+        "mean_ms": round(float(latencies_ms.mean()), 3),
+        "p50_ms": round(float(np.percentile(latencies_ms, 50)), 3),
+        "p95_ms": round(float(np.percentile(latencies_ms, 95)), 3),
+        "p99_ms": round(float(np.percentile(latencies_ms, 99)), 3),
+        "max_ms": round(float(latencies_ms.max()), 3),
+    }
+
+
+# Run count requests built by build(number) -> (method, path, params, payload)
+# through send() on concurrency threads
+def run_requests(send, build, count, concurrency):
+    latencies = [0.0] * count
+
+    def run(number):
+        method, path, params, payload = build(number)
+        start = time.perf_counter()
+        status = send(method, path, params, payload)
+        latencies[number] = time.perf_counter() - start
+        return status
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        statuses = list(executor.map(run, range(count)))
+    wall_seconds = time.perf_counter() - start
+    return summarize(latencies, sum(1 for status in statuses if status >= 400), wall_seconds)
+
+
+# API
+
+# Requests of each scenario, by name. The first part of the name is the route.
+# Reads come first, so they run on the generated data; every write scenario
+# touches its own records.
+def api_scenarios(rows, count, seed):
+    today = date.today()
+    products = product_count(rows)
+    deleted = random.Random(seed).sample(range(1, rows + 1), min(count, rows))
+    deleted_set = set(deleted)
+    renewed = [index for index in range(1, rows + 1) if index not in deleted_set][:count] or [1]
+
+    def random_date(rng):
+        return (today + timedelta(days=rng.randint(-730, 730))).isoformat()
+
+    def new_subscription(rng, number):
+        return {"client_name": f"Benchmark {number}", "product_name": f"Produto {rng.randint(1, products)}",
+                "end_date": random_date(rng), "license_key": f"{rng.getrandbits(64):016X}"}
+
+    def expiring_range(rng):
+        start = today + timedelta(days=rng.randint(-30, 30))
+        return {"from": start.isoformat(), "to": (start + timedelta(days=30)).isoformat()}
+
+    def scenario(build):
+        return lambda number: build(random.Random(seed * 1000003 + number), number)
+
+    return [
+        ("is_api_online", scenario(lambda rng, n: ("GET", "/is_api_online", None, None))),
+        ("view_subscriptions", scenario(lambda rng, n: ("GET", "/view_subscriptions", None, None))),
+        ("view_subscriptions?q", scenario(lambda rng, n: (
+            "GET", "/view_subscriptions", {"q": rng.choice(CLIENT_NAMES).lower()[:4], "limit": 50}, None))),
+        ("view_subscriptions?sort", scenario(lambda rng, n: (
+            "GET", "/view_subscriptions", {"sort": rng.choice(["end_date", "-client_name", "license_key"]),
+                                           "limit": 200, "offset": rng.randrange(rows)}, None))),
+        ("view_subscriptions?end_after", scenario(lambda rng, n: (
+            "GET", "/view_subscriptions", {"end_after": random_date(rng), "sort": "end_date", "limit": 100}, None))),
+        ("expiring", scenario(lambda rng, n: ("GET", "/expiring", expiring_range(rng), None))),
+        ("changes", scenario(lambda rng, n: ("GET", "/changes", {"since": 0}, None))),
+        ("get_products", scenario(lambda rng, n: ("GET", "/get_products", None, None))),
+        ("search_products", scenario(lambda rng, n: (
+            "GET", "/search_products", {"q": f"produto {rng.randint(1, products)}", "limit": 20}, None))),
+        ("metrics", scenario(lambda rng, n: ("GET", "/metrics", None, None))),
+        ("add_subscription", scenario(lambda rng, n: ("POST", "/add_subscription", None, new_subscription(rng, n)))),
+        ("add_subscriptions_bulk", scenario(lambda rng, n: (
+            "POST", "/add_subscriptions_bulk", None,
+            {"subscriptions": [new_subscription(rng, n * 100 + item) for item in range(100)]}))),
+        ("renew_subscription", scenario(lambda rng, n: (
+            "POST", "/renew_subscription", None, {"index": renewed[n % len(renewed)], "new_end_date": random_date(rng)}))),
+        ("delete_subscription", scenario(lambda rng, n: (
+            "DELETE", "/delete_subscription", None, {"index": deleted[n % len(deleted)]}))),
+        ("add_product", scenario(lambda rng, n: ("POST", "/add_product", None, {"product_name": f"Novo {n}"}))),
+        ("add_products_bulk", scenario(lambda rng, n: (
+            "POST", "/add_products_bulk", None, {"product_names": [f"Lote {n}-{item}" for item in range(100)]}))),
+        ("delete_product", scenario(lambda rng, n: ("DELETE", "/delete_product", None, {"product_name": f"Novo {n}"}))),
+    ]
+
+
+def test_client_sender(app):
+    local = threading.local()
+
+    def send(method, path, params, payload):
+        if not hasattr(local, "client"):
+            local.client = app.test_client()
+        response = local.client.open(path, method=method, query_string=params, json=payload)
+        response.get_data()
+        return response.status_code
+
+    return send
+
+
+def socket_sender(base_url):
+    local = threading.local()
+
+    def send(method, path, params, payload):
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        response = local.session.request(method, base_url + path, params=params, json=payload, timeout=300)
+        return response.status_code
+
+    return send
+
+
+def benchmark_api(config, data_dir, rows, args):
+    # The API only creates its store (over the files next to it) when asked
+    # to; the benchmark installs a store over the generated data instead and
+    # never touches another one
+    import Subscription_API as api
+    from werkzeug.serving import make_server
+
+    if api.store is not None:
+        raise RuntimeError("Subscription_API already has a store; the benchmark needs the module to itself.")
+    store = api.store = SubscriptionStore(create_backend(config, data_dir), flush_policy=api.flush_policy,
+                                          flush_interval_ms=api.flush_interval_ms)
+    api.response_cache.clear()
+
+    scenarios = api_scenarios(rows, args.requests, args.seed)
+    covered = {name.split("?")[0] for name, _ in scenarios}
+    routes = {rule.endpoint for rule in api.app.url_map.iter_rules() if rule.endpoint != "static"}
+    if routes - covered:
+        print(f"Routes without a scenario: {', '.join(sorted(routes - covered))}")
+
+    transports = [("test_client", test_client_sender(api.app), None)]
+    if args.socket:
+        # No log line per request
+        logging.getLogger("werkzeug").setLevel(logging.ERROR)
+        server = make_server("127.0.0.1", 0, api.app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        transports.append(("socket", socket_sender(f"http://127.0.0.1:{server.server_port}"), server))
+
+    results = []
+    try:
+        for transport, send, server in transports:
+            if transport == "socket":
+                # Start from the generated data again
+                store.close()
+                generate_data(data_dir, rows, args.seed)
+                for name in os.listdir(data_dir):
+                    if name not in ("subscriptions.json", "products.json", "store_meta.json"):
+                        os.remove(os.path.join(data_dir, name))
+                store = api.store = SubscriptionStore(create_backend(config, data_dir), flush_policy=api.flush_policy,
+                                                      flush_interval_ms=api.flush_interval_ms)
+                api.response_cache.clear()
+            routes_result = {}
+            for name, build in scenarios:
+                with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+                    routes_result[name] = run_requests(send, build, args.requests, args.concurrency)
+                stats = routes_result[name]
+                print(f"  {transport:<11} {name:<30} p50 {stats['p50_ms']:>9.3f} ms  p99 {stats['p99_ms']:>9.3f} ms"
+                      f"  {stats['throughput_per_second']:>9} req/s  errors {stats['errors']}")
+            results.append({"rows": rows, "transport": transport, "concurrency": args.concurrency,
+                            "routes": routes_result})
+            if server is not None:
+                server.shutdown()
+    finally:
+        store.close()
+        api.store = None
+        api.response_cache.clear()
+    return results
+
+
+# Checker
+
+# Just enough SMTP for smtplib: every message is accepted and counted
+class StubSMTPHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write(line.encode("ascii") + b"\r\n")
+
+    def handle(self):
+        self.reply("220 localhost stub SMTP")
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].decode("ascii", "replace").upper()
+            if command == "EHLO":
+                self.reply("250 localhost")
+            elif command in ("HELO", "MAIL", "RCPT", "RSET", "NOOP"):
+                self.reply("250 OK")
+            elif command == "DATA":
+                self.reply("354 End data with <CR><LF>.<CR><LF>")
+                for data_line in self.rfile:
+                    if data_line in (b".\r\n", b".\n"):
+                        break
+                self.server.count_message()
+                self.reply("250 OK")
+            elif command == "QUIT":
+                self.reply("221 Bye")
+                return
+            else:
+                self.reply("502 Command not implemented")
+
+
+class StubSMTPServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), StubSMTPHandler)
+        self.messages = 0
+        self._lock = threading.Lock()
+
+    def count_message(self):
+        with self._lock:
+            self.messages += 1
+
+
+def timed(function):
+    start = time.perf_counter()
+    result = function()
+    return result, round(time.perf_counter() - start, 4)
+
+
+def benchmark_checker(config, data_dir, rows, smtp_server, args):
+    outbox_path = os.path.join(data_dir, "outbox.jsonl")
+    if os.path.exists(outbox_path):
+        os.remove(outbox_path)
+    smtp_session = SMTPSession("127.0.0.1", smtp_server.server_address[1], SENDER_EMAIL, "", security="none")
+    outbox = Outbox(outbox_path)
+    dispatcher = EmailDispatcher(outbox, smtp_session.new_session, SENDER_EMAIL, workers=args.smtp_workers,
+                                 rate_limit_per_second=0)
+    checker = SubscriptionChecker("127.0.0.1", smtp_session.smtp_port, SENDER_EMAIL, "", "receiver@example.com",
+                                  os.path.join(data_dir, "subscriptions.json"), backend=create_backend(config, data_dir),
+                                  smtp_session=smtp_session, outbox=outbox, dispatcher=dispatcher)
+
+    first_date = date.today()
+    last_date = first_date + timedelta(days=args.notice_days - 1)
+    messages_before = smtp_server.messages
+    with open(os.devnull, "w") as devnull, redirect_stdout(devnull):
+        _, load_seconds = timed(checker.load_subscriptions)
+        _, reload_seconds = timed(checker.load_subscriptions)
+        notices, collect_seconds = timed(lambda: checker.collect_notices(first_date, last_date))
+        _, queue_seconds = timed(lambda: checker.send_email_notifications(first_date, last_date))
+        dispatcher.start()
+        _, dispatch_seconds = timed(outbox.wait_idle)
+        dispatcher.stop()
+    outbox.close()
+    checker.backend.close()
+
+    result = {
+        "rows": rows,
+        "notice_days": args.notice_days,
+        "notices": len(notices),
+        "messages_received": smtp_server.messages - messages_before,
+        "load_seconds": load_seconds,
+        "reload_unchanged_seconds": reload_seconds,
+        "collect_seconds": collect_seconds,
+        "queue_seconds": queue_seconds,
+        "dispatch_seconds": dispatch_seconds,
+        "messages_per_second": round(len(notices) / dispatch_seconds, 1) if dispatch_seconds else None,
+    }
+    print(f"  checker     {len(notices)} notices: load {load_seconds} s, collect {collect_seconds} s,"
+          f" queue {queue_seconds} s, dispatch {dispatch_seconds} s")
+    return result
+
+
+# Excel import
+
+def benchmark_excel(data_dir, rows, args):
+    path = os.path.join(data_dir, "import.xlsx")
+    _, generate_seconds = timed(lambda: generate_workbook(path, rows, args.seed))
+
+    # Only the reading and parsing is measured, the upload is answered at once
+    def post_bulk(route, payload):
+        items = payload.get("subscriptions") or payload.get("product_names") or []
+        return [{"status": 200}] * len(items)
+
+    job = ExcelImportJob(path, post_bulk, chunk_size=500)
+    _, import_seconds = timed(job.run)
+    if job.error is not None:
+        raise job.error
+
+    result = {
+        "rows": rows,
+        "file_bytes": os.path.getsize(path),
+        "generate_seconds": generate_seconds,
+        "import_seconds": import_seconds,
+        "rows_per_second": round(job.rows_read / import_seconds, 1) if import_seconds else None,
+        "imported": job.imported,
+        "invalid_dates": len(job.invalid_dates),
+    }
+    print(f"  excel       {job.rows_read} rows parsed in {import_seconds} s ({result['rows_per_second']} rows/s)")
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the subscription API, checker and Excel import.")
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        help="comma separated subscription counts, e.g. 1000,10000,100000,1000000")
+    parser.add_argument("--only", default="api,checker,excel", help="comma separated parts to run")
+    parser.add_argument("--requests", type=int, default=200, help="requests per API scenario")
+    parser.add_argument("--concurrency", type=int, default=8, help="threads sending API requests")
+    parser.add_argument("--socket", action="store_true", help="also send the requests through a real HTTP server")
+    parser.add_argument("--notice-days", type=int, default=7, help="days of notices the checker sends")
+    parser.add_argument("--smtp-workers", type=int, default=4, help="checker dispatcher threads")
+    parser.add_argument("--backend", choices=("json", "sqlite"), help="storage backend, [Storage] of config.ini by default")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--label", default="", help="name of this run in the results, e.g. a version")
+    parser.add_argument("--output", default="benchmark_results.json")
+    parser.add_argument("--keep-data", action="store_true", help="keep the generated data directories")
+    args = parser.parse_args()
+
+    sizes = [int(size) for size in args.sizes.split(",") if size.strip()]
+    parts = {part.strip() for part in args.only.split(",")}
+
+    config = configparser.ConfigParser()
+    config.read(os.path.join(script_dir, "config.ini"))
+    if args.backend:
+        if not config.has_section("Storage"):
+            config.add_section("Storage")
+        config.set("Storage", "backend", args.backend)
+    # The API and the checker log as they do in production, into a file next to the results
+    configure_logging(config, "benchmark", os.path.splitext(args.output)[0] + ".log")
+
+    results = {
+        "label": args.label,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "backend": config.get("Storage", "backend", fallback="json"),
+        "flush_policy": config.get("Storage", "flush_policy", fallback="immediate"),
+        "sizes": sizes,
+        "api": [],
+        "checker": [],
+        "excel": [],
+    }
+
+    smtp_server = None
+    if "checker" in parts:
+        smtp_server = StubSMTPServer()
+        threading.Thread(target=smtp_server.serve_forever, daemon=True).start()
+
+    try:
+        for rows in sizes:
+            data_dir = tempfile.mkdtemp(prefix=f"subscription-benchmark-{rows}-")
+            print(f"{rows} subscriptions ({data_dir})")
+            try:
+                _, seconds = timed(lambda: generate_data(data_dir, rows, args.seed))
+                print(f"  generated in {seconds} s")
+                if "api" in parts:
+                    results["api"] += benchmark_api(config, data_dir, rows, args)
+                if "checker" in parts:
+                    results["checker"].append(benchmark_checker(config, data_dir, rows, smtp_server, args))
+                if "excel" in parts:
+                    results["excel"].append(benchmark_excel(data_dir, rows, args))
+            finally:
+                if not args.keep_data:
+                    shutil.rmtree(data_dir, ignore_errors=True)
+    finally:
+        if smtp_server is not None:
+            smtp_server.shutdown()
+            smtp_server.server_close()
+
+    with open(args.output, "w") as file:
+        json.dump(results, file, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
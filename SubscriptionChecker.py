@@ -1,5 +1,6 @@
 import os
 import json
+import logging
 import smtplib
 import threading
 import time
@@ -8,101 +9,475 @@ from email.mime.multipart import MIMEMultipart
 from datetime import datetime, timedelta
 import configparser
 import sys
+import html
+import requests
+import numpy as np
+import pandas as pd
+from StorageBackend import JsonFileBackend, create_backend, atomic_write, read_json, apply_operation
+from NotificationOutbox import Outbox, EmailDispatcher
+from SubscriptionMetrics import REGISTRY, serve_metrics
+from SubscriptionLogging import configure_logging
+
+logger = logging.getLogger("subscription.checker")
+
+# Checker metrics, served on [Checker] metrics_port with the storage and email metrics
+RUN_SECONDS = REGISTRY.histogram("subscription_checker_run_duration_seconds",
+                                 "Duration of a checker pass: loading the data and queueing the due notices.")
+RUNS = REGISTRY.counter("subscription_checker_runs_total", "Checker passes, by result.", ("result",))
+LAST_RUN = REGISTRY.gauge("subscription_checker_last_run_timestamp_seconds", "Time of the last completed pass.")
+SUBSCRIPTIONS_LOADED = REGISTRY.gauge("subscription_checker_subscriptions", "Subscriptions in the last load.")
+ROWS_SCANNED = REGISTRY.counter("subscription_checker_rows_scanned_total",
+                                "Subscriptions read by reloads of changed data.")
+DATES_PARSED = REGISTRY.counter("subscription_checker_dates_parsed_total", "New or changed end dates parsed.")
+NOTICES_QUEUED = REGISTRY.counter("subscription_checker_notices_queued_total", "Notices queued for sending, by kind.",
+                                  ("kind",))
+
+# Days before the end date a notice is sent, negative for overdue notices
+# after it. Keyed by lowercase product name, "" holds the default offsets.
+DEFAULT_REMINDERS = {"": [45, 0]}
+
+
+# Reminder offsets from the [Reminders] section: "default = 45, 0" and one
+# line per product that needs other offsets, e.g. "Product A = 90, 30, 7, 1, 0, -7"
+def read_reminders(config):
+    reminders = dict(DEFAULT_REMINDERS)
+    if config.has_section("Reminders"):
+        for product_name, value in config.items("Reminders"):
+            offsets = sorted({int(offset) for offset in value.split(",") if offset.strip()}, reverse=True)
+            reminders["" if product_name == "default" else product_name.lower()] = offsets
+    return reminders
+
+
+# Notice type of an offset, part of the notice's idempotency key
+def notice_type(offset):
+    if offset > 0:
+        return f"warning-{offset}"
+    if offset < 0:
+        return f"overdue-{-offset}"
+    return "expiration"
+
+
+# Digest label of a subscription ending days from today
+def notice_label(days):
+    if days > 0:
+        return f"Expira em {days} dias"
+    if days < 0:
+        return f"Expirou há {-days} dias"
+    return "Expira hoje"
+
+# One SMTP connection reused for many messages. It connects on the first send,
+# reconnects when the server has dropped it and after max_messages_per_connection
+# messages, and is closed when the with block around a notification run ends.
+class SMTPSession:
+    def __init__(self, smtp_server, smtp_port, sender_email, sender_password, security="ssl",
+                 max_messages_per_connection=100, timeout=30):
+        self.smtp_server = smtp_server
+        self.smtp_port = smtp_port
+        self.sender_email = sender_email
+        self.sender_password = sender_password
+        # ssl: SMTP over TLS, starttls: plain connection upgraded with STARTTLS, none: no TLS
+        self.security = security
+        self.max_messages_per_connection = max_messages_per_connection
+        self.timeout = timeout
+        self.connection = None
+        self.messages_sent = 0
+
+    # A new, unconnected session with the same settings
+    def new_session(self):
+        return SMTPSession(self.smtp_server, self.smtp_port, self.sender_email, self.sender_password, self.security,
+                           self.max_messages_per_connection, self.timeout)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def connect(self):
+        self.close()
+        if self.security == "ssl":
+            connection = smtplib.SMTP_SSL(self.smtp_server, self.smtp_port, timeout=self.timeout)
+        else:
+            connection = smtplib.SMTP(self.smtp_server, self.smtp_port, timeout=self.timeout)
+            if self.security == "starttls":
+                connection.starttls()
+        if self.sender_password:
+            connection.login(self.sender_email, self.sender_password)
+        self.connection = connection
+        self.messages_sent = 0
+
+    def close(self):
+        if self.connection is not None:
+            try:
+                self.connection.quit()
+            except (smtplib.SMTPException, OSError):
+                pass
+            self.connection = None
+
+    def send(self, message, receiver_email):
+        if self.connection is None or self.messages_sent >= self.max_messages_per_connection:
+            self.connect()
+        try:
+            self.connection.sendmail(self.sender_email, receiver_email, message.as_string())
+        except (smtplib.SMTPServerDisconnected, ConnectionError):
+            # The server closed the idle connection, retry once on a new one
+            self.connect()
+            self.connection.sendmail(self.sender_email, receiver_email, message.as_string())
+        self.messages_sent += 1
+
+
+# Reads the subscriptions through the API's /changes feed instead of the data
+# files. A local copy is kept and only the operations since the last seen seq
+# are fetched; it can stand in for a storage backend in SubscriptionChecker.
+class ChangeFeedSource:
+    def __init__(self, api_url, timeout=30):
+        self.api_url = api_url.rstrip("/")
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.state = {"subscriptions": {}, "products": {}, "next_index": 1, "last_seq": 0}
+        self.synced = False
+
+    # Fetching the feed is what tells whether anything changed, so this syncs
+    # the local copy and returns its seq
+    def fingerprint(self):
+        since = self.state["last_seq"] if self.synced else 0
+        response = self.session.get(f"{self.api_url}/changes", params={"since": since}, timeout=self.timeout)
+        response.raise_for_status()
+        feed = response.json()
+        if feed.get("reset"):
+            self.state["subscriptions"] = {subscription.get("index", 0): subscription
+                                           for subscription in feed["subscriptions"]}
+        else:
+            for operation in feed["changes"]:
+                apply_operation(self.state, operation)
+        self.state["last_seq"] = feed["last_seq"]
+        self.synced = True
+        return feed["last_seq"]
+
+    def load_subscriptions(self):
+        if not self.synced:
+            self.fingerprint()
+        return list(self.state["subscriptions"].values())
+
 
 class SubscriptionChecker:
-    def __init__(self, smtp_server, smtp_port, sender_email, sender_password, receiver_email, subscriptions_file):
+    def __init__(self, smtp_server, smtp_port, sender_email, sender_password, receiver_email, subscriptions_file, backend=None,
+                 smtp_session=None, outbox=None, dispatcher=None, digest=False, notify_hour=10,
+                 reload_interval_seconds=300, reminders=None):
         self.smtp_server = smtp_server
         self.smtp_port = smtp_port
         self.sender_email = sender_email
         self.sender_password = sender_password
         self.receiver_email = receiver_email
+        self.smtp_session = smtp_session or SMTPSession(smtp_server, smtp_port, sender_email, sender_password)
         self.subscriptions_file = subscriptions_file
+        # Storage backend the API writes to, the JSON files next to subscriptions_file by default
+        self.backend = backend or JsonFileBackend(os.path.dirname(subscriptions_file))
+        # Notices are queued in the outbox and sent by the dispatcher's workers,
+        # so a failed send is retried instead of lost
+        self.outbox = outbox or Outbox(os.path.join(os.path.dirname(subscriptions_file), "outbox.jsonl"))
+        self.dispatcher = dispatcher or EmailDispatcher(self.outbox, self.smtp_session.new_session, sender_email)
+        # Send one aggregated email per run instead of one per subscription
+        self.digest = digest
+        # Notices of a day are due at this hour
+        self.notify_hour = notify_hour
+        # Upper bound on the sleep between two looks at the subscription data
+        self.reload_interval_seconds = reload_interval_seconds
+        # Time up to which every due notice has been queued, kept across restarts
+        self.state_file = os.path.join(os.path.dirname(subscriptions_file), "checker_state.json")
+        self.subscriptions = []
+        # Backend fingerprint of the loaded subscriptions, None before the first load
+        self.loaded_fingerprint = None
+        # index -> (end_date string, parsed date), so only changed dates are parsed again
+        self.end_dates = {}
+        self.reminders = reminders or DEFAULT_REMINDERS
+        # Reminder group ("" or a product) -> (sorted end dates, positions in
+        # self.subscriptions), rebuilt when the subscriptions are loaded
+        self.end_date_columns = {}
         self.running = False
+        self._wakeup = threading.Event()
 
     def start(self):
         self.running = True
+        self._wakeup.clear()
+        self.dispatcher.start()
         threading.Thread(target=self.check_subscriptions).start()
 
     def stop(self):
         self.running = False
+        self._wakeup.set()
+        self.dispatcher.stop()
 
+    # Sleeps until the next notice event (or the next data reload) and queues
+    # everything that became due since the watermark. After downtime the first
+    # pass catches up on all the notices that were missed, in one batch.
     def check_subscriptions(self):
-        first_run = True
+        logger.info("SubscriptionChecker is running")
+        watermark = self.load_watermark()
         while self.running:
-            # Get the time until the next 10 o'clock
+            start = time.perf_counter()
+            try:
+                self.load_subscriptions()
+            except Exception:
+                # The watermark stays put, the missed notices are queued once loading works again
+                logger.exception("Error loading subscriptions")
+                RUNS.inc(result="error")
+                self._wakeup.wait(self.reload_interval_seconds)
+                continue
+
             now = datetime.now()
-            next_check = datetime(now.year, now.month, now.day, 10, 0, 0)
-            if now >= next_check:
-                next_check += timedelta(days=1)  # Next day if already past 10 o'clock today
-            sleep_time = (next_check - now).total_seconds()
+            first_date, last_date = self.notice_dates_between(watermark, now)
+            if first_date <= last_date:
+                self.send_email_notifications(first_date, last_date)
+            watermark = now
+            self.save_watermark(watermark)
+            RUN_SECONDS.observe(time.perf_counter() - start)
+            RUNS.inc(result="ok")
+            LAST_RUN.set(time.time())
 
-            if first_run:
-                print("SubscriptionChecker is running for the first time.")
-                first_run = False
+            sleep_time = self.reload_interval_seconds
+            next_notice = self.next_notice_time(watermark)
+            if next_notice is not None:
+                sleep_time = min(sleep_time, (next_notice - now).total_seconds())
+            self._wakeup.wait(max(sleep_time, 0))
 
-            time.sleep(sleep_time)  # Sleep until the next 10 o'clock
-            self.load_subscriptions()
-            self.send_email_notifications()
+    def load_watermark(self):
+        state = read_json(self.state_file, {})
+        if "last_processed" in state:
+            return datetime.fromisoformat(state["last_processed"])
+        # First start: nothing was missed yet
+        return datetime.now()
 
+    def save_watermark(self, watermark):
+        atomic_write(self.state_file, json.dumps({"last_processed": watermark.isoformat()}))
+
+    # Time of the first notice after the watermark, None when there is none
+    def next_notice_time(self, watermark):
+        first_date = np.datetime64(self.notice_dates_between(watermark, watermark)[0], "D")
+        next_date = None
+        for group, (end_dates, _) in self.end_date_columns.items():
+            for offset in self.reminders[group]:
+                # The first end date whose notice day is on or after first_date
+                position = end_dates.searchsorted(first_date + np.timedelta64(offset, "D"))
+                if position < len(end_dates):
+                    notice_date = end_dates[position] - np.timedelta64(offset, "D")
+                    if next_date is None or notice_date < next_date:
+                        next_date = notice_date
+        if next_date is None:
+            return None
+        return datetime.combine(next_date.astype(object), datetime.min.time()).replace(hour=self.notify_hour)
+
+    # First and last notice day whose notify time falls in (start, end]
+    def notice_dates_between(self, start, end):
+        first_date = start.date() if start.hour < self.notify_hour else start.date() + timedelta(days=1)
+        last_date = end.date() if end.hour >= self.notify_hour else end.date() - timedelta(days=1)
+        return first_date, last_date
+
+    # Returns whether anything was (re)loaded. Unchanged data, according to
+    # the backend's fingerprint, is not read again.
     def load_subscriptions(self):
-        self.subscriptions = []
-        with open(self.subscriptions_file, "r") as file:
-            self.subscriptions = json.load(file)
+        fingerprint = self.backend.fingerprint()
+        if fingerprint is not None and fingerprint == self.loaded_fingerprint:
+            return False
+        # Read through the storage backend: with the JSON files the API keeps
+        # recent changes in its journal, which is replayed on top of the snapshot
+        self.subscriptions = self.backend.load_subscriptions()
+        self.loaded_fingerprint = fingerprint
+        SUBSCRIPTIONS_LOADED.set(len(self.subscriptions))
+        ROWS_SCANNED.inc(len(self.subscriptions))
 
-    def send_email_notifications(self):
-        today = datetime.today().date()
+        end_dates = {}
+        changed = []
         for subscription in self.subscriptions:
-            if isinstance(subscription, dict):
-                end_date_str = subscription.get("end_date")
-                if end_date_str:
-                    end_date = datetime.strptime(end_date_str, "%Y-%m-%d").date()
-                    # Check if the subscription is due for a warning 45 days before expiration
-                    if today + timedelta(days=45) == end_date:
-                        self.send_warning_email(subscription)
-                    elif end_date == today:
-                        self.send_email(subscription)
-
-    def send_warning_email(self, subscription):
+            if not isinstance(subscription, dict):
+                continue
+            index = subscription.get("index")
+            end_date_str = subscription.get("end_date")
+            cached = self.end_dates.get(index)
+            if cached is not None and cached[0] == end_date_str:
+                end_dates[index] = cached
+            elif end_date_str:
+                changed.append((index, end_date_str))
+        # New and changed dates are parsed together in one vectorized call. A
+        # malformed date only leaves its own subscription without notices.
+        if changed:
+            DATES_PARSED.inc(len(changed))
+            parsed = pd.to_datetime([str(end_date_str) for _, end_date_str in changed], format="%Y-%m-%d",
+                                    errors="coerce")
+            invalid = []
+            for (index, end_date_str), end_date in zip(changed, parsed.to_numpy(dtype="datetime64[D]")):
+                if np.isnat(end_date):
+                    invalid.append(index)
+                else:
+                    end_dates[index] = (end_date_str, end_date)
+            if invalid:
+                logger.warning("Skipping subscriptions with an invalid end date",
+                               extra={"fields": {"count": len(invalid), "indexes": invalid[:20]}})
+        self.end_dates = end_dates
+        self.build_end_date_columns()
+        return True
+
+    # One column of end dates for all subscriptions, grouped by the reminder
+    # offsets that apply to them and sorted, so each reminder window is a
+    # binary search instead of a scan over every subscription
+    def build_end_date_columns(self):
+        positions, groups, end_dates = [], [], []
+        for position, subscription in enumerate(self.subscriptions):
+            cached = self.end_dates.get(subscription.get("index")) if isinstance(subscription, dict) else None
+            if cached is None:
+                continue
+            product_key = str(subscription.get("product_name") or "").lower()
+            positions.append(position)
+            groups.append(product_key if product_key in self.reminders else "")
+            end_dates.append(cached[1])
+        frame = pd.DataFrame({
+            "group": pd.Series(groups, dtype=object),
+            "end_date": np.array(end_dates, dtype="datetime64[D]"),
+            "position": np.array(positions, dtype=np.int64),
+        }).sort_values(["group", "end_date", "position"], kind="stable")
+        self.end_date_columns = {
+            group: (rows["end_date"].to_numpy(dtype="datetime64[D]"), rows["position"].to_numpy())
+            for group, rows in frame.groupby("group", sort=False)
+        }
+
+    # Queue the notices of the days first_date..last_date (today by default)
+    def send_email_notifications(self, first_date=None, last_date=None):
+        first_date = first_date or datetime.today().date()
+        last_date = last_date or first_date
+        notices = self.collect_notices(first_date, last_date)
+        logger.info("Notices due", extra={"fields": {"first_date": first_date.isoformat(),
+                                                      "last_date": last_date.isoformat(), "notices": len(notices)}})
+        if self.digest:
+            if notices:
+                self.send_digest_email(notices, first_date, last_date)
+            return
+        # A notice caught up after downtime tells the days left as of today,
+        # not as of the day it was due; its idempotency key keeps the offset
+        today = datetime.today().date()
+        for offset, subscription in notices:
+            days = self.days_until_end(subscription, today)
+            if days > 0:
+                self.send_warning_email(subscription, days, offset)
+            elif days < 0:
+                self.send_overdue_email(subscription, -days, offset)
+            else:
+                self.send_email(subscription, offset)
+
+    # Days from today to the end date (negative once it passed), from the
+    # end dates parsed by load_subscriptions
+    def days_until_end(self, subscription, today):
+        end_date = self.end_dates[subscription.get("index")][1]
+        return int((end_date - np.datetime64(today, "D")) // np.timedelta64(1, "D"))
+
+    # (offset, subscription) pairs with a notice day, end date minus offset,
+    # between first_date and last_date, in the order of the subscriptions. Each
+    # offset of each reminder group selects a slice of the sorted end date column.
+    def collect_notices(self, first_date, last_date):
+        first_date = np.datetime64(first_date, "D")
+        last_date = np.datetime64(last_date, "D")
+        positions, offsets = [], []
+        for group, (end_dates, group_positions) in self.end_date_columns.items():
+            for offset in self.reminders[group]:
+                delta = np.timedelta64(offset, "D")
+                low = end_dates.searchsorted(first_date + delta, side="left")
+                high = end_dates.searchsorted(last_date + delta, side="right")
+                positions.append(group_positions[low:high])
+                offsets.append(np.full(high - low, offset, dtype=np.int64))
+        if not positions:
+            return []
+        positions = np.concatenate(positions)
+        offsets = np.concatenate(offsets)
+        order = np.lexsort((-offsets, positions))
+        return [(int(offsets[i]), self.subscriptions[positions[i]]) for i in order]
+
+    # Idempotency key of a notice: the same notice for the same subscription
+    # and end date is only ever sent once
+    def notification_key(self, subscription, kind):
+        return f"{subscription.get('index')}:{subscription['end_date']}:{kind}"
+
+    # offset is the reminder the notice is for, days by default
+    def send_warning_email(self, subscription, days=45, offset=None):
         client_name = subscription["client_name"]
         product_name = subscription["product_name"]
         end_date = subscription["end_date"]
         subject = f"Aviso de Expiração da Assinatura: {client_name}"
-        body = f"Prezado usuário,\n\nSua assinatura para {product_name} (cliente: {client_name}) está expirando em 45 dias ({end_date}).\nPor favor, considere renová-la.\n\nAtenciosamente,\nSeu Gerenciador de Assinaturas"
-
-        message = MIMEMultipart()
-        message['From'] = self.sender_email
-        message['To'] = self.receiver_email
-        message['Subject'] = subject
-        message.attach(MIMEText(body, 'plain'))
+        body = f"Prezado usuário,\n\nSua assinatura para {product_name} (cliente: {client_name}) está expirando em {days} dias ({end_date}).\nPor favor, considere renová-la.\n\nAtenciosamente,\nSeu Gerenciador de Assinaturas"
 
         try:
-            with smtplib.SMTP_SSL(self.smtp_server, self.smtp_port) as smtp_server:
-                smtp_server.login(self.sender_email, self.sender_password)
-                smtp_server.sendmail(self.sender_email, self.receiver_email, message.as_string())
-            print(f"Warning email sent for subscription: {client_name}")
-        except Exception as e:
-            print(f"Error sending warning email: {e}")
-
-    def send_email(self, subscription):
+            if self.outbox.enqueue(self.notification_key(subscription, notice_type(days if offset is None else offset)), self.receiver_email, subject, body):
+                NOTICES_QUEUED.inc(kind="warning")
+                logger.debug("Notice queued", extra={"fields": {"index": subscription.get("index"), "kind": "warning"}})
+        except Exception:
+            logger.exception("Error queueing warning email")
+
+    def send_email(self, subscription, offset=0):
         client_name = subscription["client_name"]
         product_name = subscription["product_name"]
         end_date = subscription["end_date"]
         subject = f"Expiração da Assinatura: {client_name}"
         body = f"Prezado usuário,\n\nSua assinatura para {product_name} (cliente: {client_name}) está expirando hoje ({end_date}).\n\nAtenciosamente,\nSeu Gerenciador de Assinaturas"
 
-        message = MIMEMultipart()
-        message['From'] = self.sender_email
-        message['To'] = self.receiver_email
-        message['Subject'] = subject
-        message.attach(MIMEText(body, 'plain'))
+        try:
+            if self.outbox.enqueue(self.notification_key(subscription, notice_type(offset)), self.receiver_email, subject, body):
+                NOTICES_QUEUED.inc(kind="expiration")
+                logger.debug("Notice queued", extra={"fields": {"index": subscription.get("index"), "kind": "expiration"}})
+        except Exception:
+            logger.exception("Error queueing email")
+
+    def send_overdue_email(self, subscription, days, offset=None):
+        client_name = subscription["client_name"]
+        product_name = subscription["product_name"]
+        end_date = subscription["end_date"]
+        subject = f"Assinatura Expirada: {client_name}"
+        body = f"Prezado usuário,\n\nSua assinatura para {product_name} (cliente: {client_name}) expirou há {days} dias ({end_date}).\nPor favor, renove-a.\n\nAtenciosamente,\nSeu Gerenciador de Assinaturas"
+
+        try:
+            if self.outbox.enqueue(self.notification_key(subscription, notice_type(-days if offset is None else offset)), self.receiver_email, subject, body):
+                NOTICES_QUEUED.inc(kind="overdue")
+                logger.debug("Notice queued", extra={"fields": {"index": subscription.get("index"), "kind": "overdue"}})
+        except Exception:
+            logger.exception("Error queueing overdue email")
+
+    # One message with every notice of the run, as a plain text and an HTML
+    # table grouped by product
+    def send_digest_email(self, notices, first_date, last_date):
+        by_product = {}
+        for offset, subscription in notices:
+            by_product.setdefault(subscription.get("product_name") or "", []).append((offset, subscription))
+
+        if first_date == last_date:
+            period = first_date.isoformat()
+        else:
+            period = f"{first_date.isoformat()} a {last_date.isoformat()}"
+        subject = f"Resumo de Assinaturas {period}: {len(notices)} avisos"
+        lines = ["Prezado usuário,", "", f"Assinaturas com avisos em {period}:", ""]
+        rows = []
+        today = datetime.today().date()
+        for product_name in sorted(by_product):
+            lines.append(f"{product_name}")
+            lines.append(f"  {'Cliente':<30} {'Término':<10}  Aviso")
+            rows.append(f'<tr><th colspan="3" align="left">{html.escape(product_name)}</th></tr>')
+            for offset, subscription in sorted(by_product[product_name], key=lambda notice: notice[1]["end_date"]):
+                client_name = str(subscription.get("client_name") or "")
+                label = notice_label(self.days_until_end(subscription, today))
+                lines.append(f"  {client_name:<30} {subscription['end_date']:<10}  {label}")
+                rows.append(f"<tr><td>{html.escape(client_name)}</td><td>{subscription['end_date']}</td>"
+                            f"<td>{label}</td></tr>")
+            lines.append("")
+        lines += ["Atenciosamente,", "Seu Gerenciador de Assinaturas"]
+        body = "\n".join(lines)
+        html_body = (f"<p>Prezado usuário,</p><p>Assinaturas com avisos em {period}:</p>"
+                     f'<table border="1" cellpadding="4" cellspacing="0">'
+                     f"<tr><th>Cliente</th><th>Término</th><th>Aviso</th></tr>{''.join(rows)}</table>"
+                     f"<p>Atenciosamente,<br>Seu Gerenciador de Assinaturas</p>")
 
+        key = f"digest:{first_date.isoformat()}:{last_date.isoformat()}:{self.receiver_email}"
         try:
-            with smtplib.SMTP_SSL(self.smtp_server, self.smtp_port) as smtp_server:
-                smtp_server.login(self.sender_email, self.sender_password)
-                smtp_server.sendmail(self.sender_email, self.receiver_email, message.as_string())
-            print(f"Email notification sent for subscription: {client_name}")
-        except Exception as e:
-            print(f"Error sending email: {e}")
+            if self.outbox.enqueue(key, self.receiver_email, subject, body, html_body):
+                NOTICES_QUEUED.inc(kind="digest")
+                logger.info("Digest queued", extra={"fields": {"notices": len(notices)}})
+        except Exception:
+            logger.exception("Error queueing digest email")
 
 def main():
     # Get the directory where the script is located
@@ -115,16 +490,17 @@ def main():
 
     config_file = os.path.join(script_dir, 'config.ini')
 
-    if not os.path.exists(config_file):
-        print("Config file 'config.ini' not found in the script directory:", script_dir)
-        return
-    
     # Read SMTP settings from config.ini
     config = configparser.ConfigParser()
     config.read(config_file)
+    configure_logging(config, "checker")
+
+    if not os.path.exists(config_file):
+        logger.error("Config file 'config.ini' not found in the script directory", extra={"fields": {"path": script_dir}})
+        return
 
     if 'SMTP' not in config:
-        print("SMTP section not found in config.ini.")
+        logger.error("SMTP section not found in config.ini.")
         return
 
     smtp_server = config.get('SMTP', 'smtp_server', fallback='your_smtp_server')
@@ -132,18 +508,51 @@ def main():
     sender_email = config.get('SMTP', 'sender_email', fallback='your_sender_email')
     sender_password = config.get('SMTP', 'sender_password', fallback='your_sender_password')
     receiver_email = config.get('SMTP', 'receiver_email', fallback='your_receiver_email')
+    smtp_security = config.get('SMTP', 'security', fallback='ssl')
+    max_messages_per_connection = config.getint('SMTP', 'max_messages_per_connection', fallback=100)
     subscriptions_file = os.path.join(script_dir, 'subscriptions.json')
 
-    checker = SubscriptionChecker(smtp_server, smtp_port, sender_email, sender_password, receiver_email, subscriptions_file)
-    checker.start()
+    # source = storage reads the data files (or database) directly, source = api
+    # follows the API's change feed
+    if config.get('Checker', 'source', fallback='storage') == 'api':
+        api_host = config.get('API', 'host', fallback='localhost')
+        if api_host == '0.0.0.0':
+            api_host = '127.0.0.1'
+        backend = ChangeFeedSource(f"http://{api_host}:{config.getint('API', 'port', fallback=5000)}")
+    else:
+        backend = create_backend(config, script_dir)
+    smtp_session = SMTPSession(smtp_server, smtp_port, sender_email, sender_password, smtp_security,
+                               max_messages_per_connection)
+
+    outbox = Outbox(os.path.join(script_dir, 'outbox.jsonl'),
+                    max_attempts=config.getint('SMTP', 'max_attempts', fallback=8),
+                    retry_base_seconds=config.getfloat('SMTP', 'retry_base_seconds', fallback=30))
+    dispatcher = EmailDispatcher(outbox, smtp_session.new_session, sender_email,
+                                 workers=config.getint('SMTP', 'workers', fallback=4),
+                                 rate_limit_per_second=config.getfloat('SMTP', 'rate_limit_per_second', fallback=5))
 
-    # Send a test email
-    send_test_email(sender_email, sender_password, smtp_server, smtp_port, receiver_email)
+    checker = SubscriptionChecker(smtp_server, smtp_port, sender_email, sender_password, receiver_email, subscriptions_file, backend,
+                                  smtp_session, outbox, dispatcher, config.getboolean('SMTP', 'digest', fallback=False),
+                                  config.getint('Checker', 'notify_hour', fallback=10),
+                                  config.getint('Checker', 'reload_interval_seconds', fallback=300),
+                                  read_reminders(config))
+
+    # Metrics in the Prometheus text format on http://metrics_host:metrics_port/metrics, 0 turns them off
+    metrics_port = config.getint('Checker', 'metrics_port', fallback=9102)
+    if metrics_port:
+        metrics_host = config.get('Checker', 'metrics_host', fallback='127.0.0.1')
+        serve_metrics(metrics_host, metrics_port)
+        logger.info("Checker metrics served", extra={"fields": {"url": f"http://{metrics_host}:{metrics_port}/metrics"}})
+
+    # Send a test email, before the checker thread starts using the session
+    send_test_email(sender_email, sender_password, smtp_server, smtp_port, receiver_email, smtp_session)
+
+    checker.start()
 
 # The rest of the code remains unchanged
 
 
-def send_test_email(sender_email, sender_password, smtp_server, smtp_port, receiver_email):
+def send_test_email(sender_email, sender_password, smtp_server, smtp_port, receiver_email, smtp_session=None):
     subject = "Test Email"
     body = "Este é um email de teste quando inicia o script."
 
@@ -154,12 +563,11 @@ def send_test_email(sender_email, sender_password, smtp_server, smtp_port, recei
     message.attach(MIMEText(body, 'plain'))
 
     try:
-        with smtplib.SMTP_SSL(smtp_server, smtp_port) as smtp_server:
-            smtp_server.login(sender_email, sender_password)
-            smtp_server.sendmail(sender_email, receiver_email, message.as_string())
-        print("Test email sent successfully.")
-    except Exception as e:
-        print(f"Error sending test email: {e}")
+        with smtp_session or SMTPSession(smtp_server, smtp_port, sender_email, sender_password) as session:
+            session.send(message, receiver_email)
+        logger.info("Test email sent successfully.")
+    except Exception:
+        logger.exception("Error sending test email")
 
 if __name__ == "__main__":
     main()
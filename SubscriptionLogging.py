@@ -0,0 +1,210 @@
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import re
+import sys
+import threading
+from datetime import datetime, timezone
+
+# Logging for the API, the checker and the form, set up from the [Logging]
+# section of config.ini:
+#
+#   [Logging]
+#   level = INFO
+#   levels = subscription.store:DEBUG, werkzeug:WARNING
+#   format = json
+#   file =
+#   debug_sample_rate = 0.1
+#   queue_size = 10000
+#
+# Records are put on a queue by the thread that logs them and written by a
+# listener thread, so a request never waits for the console or the disk; when
+# the queue is full records are dropped and counted instead. Every record is
+# one JSON object; structured data goes in extra={"fields": {...}}:
+#
+#   logger.info("Subscription added", extra={"fields": {"index": 12}})
+#
+# License keys and the SMTP password never reach the output, in fields as well
+# as in message text.
+
+REDACTED = "***"
+# Fields whose values are never logged, at any depth
+SENSITIVE_KEYS = frozenset({"license_key", "new_license_key", "password", "sender_password", "smtp_password"})
+# "license_key": "ABC", 'license_key': 'A B C' or license_key=ABC inside a
+# text; a quoted value is matched up to its closing quote (or the end of a
+# truncated text), spaces included
+SENSITIVE_TEXT = re.compile(r"""(['"]?\b(?:%s)['"]?\s*[:=]\s*)"""
+                            r"""(?:"((?:[^"\\]|\\.)*)"?|'((?:[^'\\]|\\.)*)'?|([^'",}\s]*))"""
+                            % "|".join(sorted(SENSITIVE_KEYS, key=len, reverse=True)))
+
+_configured = None
+_configured_pid = None
+_lock = threading.Lock()
+
+
+def redact(value):
+    if isinstance(value, dict):
+        return {key: REDACTED if str(key).lower() in SENSITIVE_KEYS and value[key] else redact(value[key])
+                for key in value}
+    if isinstance(value, (list, tuple)):
+        return [redact(item) for item in value]
+    return value
+
+
+def redact_match(match):
+    prefix, double_quoted, single_quoted, bare = match.groups()
+    if double_quoted is not None:
+        return f'{prefix}"{REDACTED if double_quoted else ""}"'
+    if single_quoted is not None:
+        return f"{prefix}'{REDACTED if single_quoted else ''}'"
+    return prefix + (REDACTED if bare else "")
+
+
+def redact_text(text, secrets=()):
+    text = SENSITIVE_TEXT.sub(redact_match, text)
+    for secret in secrets:
+        text = text.replace(secret, REDACTED)
+    return text
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, component):
+        super().__init__()
+        self.component = component
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "component": self.component,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        fields = getattr(record, "fields", None)
+        if fields:
+            entry.update(fields)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+    def format(self, record):
+        text = super().format(record)
+        fields = getattr(record, "fields", None)
+        if fields:
+            text += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+        return text
+
+
+# Keeps one in every 1/rate DEBUG records of each message template (the first
+# one included), other levels pass untouched
+class SamplingFilter(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.every = max(int(round(1 / rate)), 1) if rate > 0 else 0
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno != logging.DEBUG or self.every == 1:
+            return True
+        if self.every == 0:
+            return False
+        key = (record.name, record.msg)
+        with self._lock:
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+        return count % self.every == 0
+
+
+# Hands records to the listener thread without ever blocking the caller. The
+# record is finished here (message merged, traceback formatted, secrets
+# redacted), so the listener only formats and writes it.
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, log_queue, secrets=()):
+        super().__init__(log_queue)
+        self.secrets = [secret for secret in secrets if secret]
+        self.dropped = 0
+
+    def prepare(self, record):
+        record = logging.makeLogRecord(record.__dict__)
+        record.msg = redact_text(record.getMessage(), self.secrets)
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        if record.exc_text:
+            record.exc_text = redact_text(record.exc_text, self.secrets)
+        fields = getattr(record, "fields", None)
+        if fields:
+            record.fields = {key: redact_text(value, self.secrets) if isinstance(value, str) else value
+                             for key, value in redact(fields).items()}
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+# "subscription.store:DEBUG, werkzeug:WARNING" -> {"subscription.store": "DEBUG", ...}
+def parse_levels(value):
+    levels = {}
+    for item in value.split(","):
+        if ":" in item:
+            name, level = item.rsplit(":", 1)
+            levels[name.strip()] = level.strip().upper()
+    return levels
+
+
+# Set up logging for this process once; later calls (the server importing the
+# API, for example) keep the first setup. A forked worker sets it up again,
+# the listener thread of its parent does not exist in it. default_file is used
+# when [Logging] names no file; without either, records go to stderr.
+def configure_logging(config, component, default_file=None):
+    global _configured, _configured_pid
+    with _lock:
+        if _configured is not None and _configured_pid == os.getpid():
+            return _configured
+
+        section = "Logging"
+        level = config.get(section, "level", fallback="INFO").upper()
+        log_format = config.get(section, "format", fallback="json")
+        log_file = config.get(section, "file", fallback="") or default_file
+        sample_rate = config.getfloat(section, "debug_sample_rate", fallback=0.1)
+        queue_size = config.getint(section, "queue_size", fallback=10000)
+        secrets = [config.get("SMTP", "sender_password", fallback="")]
+
+        if log_file:
+            output = logging.handlers.RotatingFileHandler(log_file, maxBytes=10 * 1024 * 1024, backupCount=5,
+                                                          encoding="utf-8")
+        else:
+            output = logging.StreamHandler(sys.stderr)
+        output.setFormatter(JsonFormatter(component) if log_format == "json" else TextFormatter())
+
+        handler = NonBlockingQueueHandler(queue.Queue(queue_size), secrets)
+        handler.addFilter(SamplingFilter(sample_rate))
+        listener = logging.handlers.QueueListener(handler.queue, output)
+        listener.start()
+        # Whatever is still queued is written before the process exits
+        atexit.register(listener.stop)
+
+        root = logging.getLogger()
+        root.handlers = [handler]
+        root.setLevel(level)
+        for name, logger_level in parse_levels(config.get(section, "levels", fallback="")).items():
+            logging.getLogger(name).setLevel(logger_level)
+        logging.captureWarnings(True)
+
+        _configured = handler
+        _configured_pid = os.getpid()
+        return handler
@@ -0,0 +1,293 @@
+import atexit
+import bisect
+import json
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Counters, gauges and histograms kept in memory by the process that records
+# them and rendered in the Prometheus text format: by the API on /metrics, by
+# the checker on a local port (serve_metrics).
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Latency buckets in seconds, from a fast in-memory read to a slow full load
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{name}="{escape_label(value)}"' for name, value in labels) + "}"
+
+
+def format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+# A metric holds one value per combination of label values, given as keyword
+# arguments: REQUESTS.inc(endpoint="view_subscriptions", status=200)
+class Metric:
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} takes the labels {', '.join(self.labelnames) or 'none'}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, value in items:
+            lines += self._render_value(list(zip(self.labelnames, key)), value)
+        return lines
+
+    def _render_value(self, labels, value):
+        return [f"{self.name}{format_labels(labels)} {format_value(value)}"]
+
+    # Copy of the values, as JSON-compatible [label values, value] pairs
+    def dump(self):
+        with self._lock:
+            return [[list(key), value] for key, value in self._values.items()]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    # Counts of several processes add up
+    def merge(self, key, value):
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    # Levels of several processes do not add up, each keeps its own series
+    # (the key then ends with the worker)
+    def merge(self, key, value):
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                # Count per bucket (the last one is +Inf), sum
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][bisect.bisect_left(self.buckets, value)] += 1
+            entry[1] += value
+
+    def dump(self):
+        with self._lock:
+            return [[list(key), [list(value[0]), value[1]]] for key, value in self._values.items()]
+
+    def merge(self, key, value):
+        counts, total = value
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0] = [mine + theirs for mine, theirs in zip(entry[0], counts)]
+            entry[1] += total
+
+    def _render_value(self, labels, value):
+        with self._lock:
+            counts, total = list(value[0]), value[1]
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            lines.append(f"{self.name}_bucket{format_labels(labels + [('le', format_value(bound))])} {cumulative}")
+        lines.append(f"{self.name}_sum{format_labels(labels)} {format_value(total)}")
+        lines.append(f"{self.name}_count{format_labels(labels)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _register(self, metric):
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is not None:
+                return existing
+            self._metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name, documentation, labelnames=()):
+        return self._register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name, documentation, labelnames=()):
+        return self._register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        with self._lock:
+            metrics = [self._metrics[name] for name in sorted(self._metrics)]
+        lines = []
+        for metric in metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+    # Everything the registry holds, as JSON-compatible data
+    def dump(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return [{"name": metric.name, "kind": metric.kind, "documentation": metric.documentation,
+                 "labelnames": list(metric.labelnames), "buckets": list(getattr(metric, "buckets", ())),
+                 "values": metric.dump()} for metric in metrics]
+
+    # Add the dump of another process; its gauges get a worker label
+    def merge(self, dump, worker):
+        for entry in dump:
+            labelnames = tuple(entry["labelnames"])
+            if entry["kind"] == "counter":
+                metric = self.counter(entry["name"], entry["documentation"], labelnames)
+            elif entry["kind"] == "histogram":
+                metric = self.histogram(entry["name"], entry["documentation"], labelnames, tuple(entry["buckets"]))
+            else:
+                metric = self.gauge(entry["name"], entry["documentation"], labelnames + ("worker",))
+            for key, value in entry["values"]:
+                if entry["kind"] == "gauge":
+                    key = key + [worker]
+                metric.merge(tuple(key), value)
+
+
+# The registry of this process, every module records into it
+REGISTRY = MetricsRegistry()
+
+STORAGE_SECONDS = REGISTRY.histogram(
+    "subscription_storage_duration_seconds", "Duration of storage loads and saves.", ("backend", "operation"))
+STORAGE_BYTES = REGISTRY.counter(
+    "subscription_storage_bytes_total", "Bytes read or written by storage loads and saves.", ("backend", "operation"))
+
+
+# Times one storage operation; the backend adds the bytes it read or wrote
+#   with StorageOperation("json", "append") as measured:
+#       measured.bytes += len(data)
+class StorageOperation:
+    def __init__(self, backend, operation):
+        self.backend = backend
+        self.operation = operation
+        self.bytes = 0
+        self.start = None
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        STORAGE_SECONDS.observe(time.perf_counter() - self.start, backend=self.backend, operation=self.operation)
+        if self.bytes:
+            STORAGE_BYTES.inc(self.bytes, backend=self.backend, operation=self.operation)
+
+
+# Several processes serving one set of metrics (API workers under gunicorn):
+# each one writes its registry to a file of its own in directory, every
+# interval seconds and whenever it answers a scrape, and the scrape is
+# answered with the sum of all the files. The files of workers that exited
+# are kept, so the totals never go down when a worker is replaced. The
+# directory is created empty by whoever starts the workers.
+class SharedMetrics:
+    def __init__(self, registry, directory, interval=5):
+        self.registry = registry
+        self.directory = directory
+        self.interval = interval
+        self.path = os.path.join(directory, f"{os.getpid()}.json")
+        self.write()
+        threading.Thread(target=self._write_loop, name="metrics-writer", daemon=True).start()
+        atexit.register(self.write)
+
+    def _write_loop(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.write()
+            except OSError:
+                pass
+
+    def write(self):
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as file:
+            json.dump(self.registry.dump(), file)
+        os.replace(tmp_path, self.path)
+
+    def render(self):
+        self.write()
+        merged = MetricsRegistry()
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name), "r") as file:
+                    dump = json.load(file)
+            except (OSError, ValueError):
+                continue
+            merged.merge(dump, name[:-len(".json")])
+        return merged.render()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    # Scrapes are not worth a log line each
+    def log_message(self, format, *args):
+        pass
+
+
+# Serve registry on http://host:port/metrics from a daemon thread
+def serve_metrics(host, port, registry=REGISTRY):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    server.registry = registry
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    return server
@@ -0,0 +1,79 @@
+import atexit
+import configparser
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from SubscriptionLogging import configure_logging
+
+# Production server for Subscription_API. With workers > 1 (gunicorn, not
+# available on Windows) every worker process loads the data itself and they
+# keep each other up to date through the files; otherwise one process serves
+# the API with waitress on several threads.
+
+if getattr(sys, 'frozen', False):  # if the application is frozen (e.g. pyinstaller)
+    script_dir = os.path.dirname(sys.executable)
+else:
+    script_dir = os.path.dirname(os.path.abspath(__file__))
+
+config = configparser.ConfigParser()
+config.read(os.path.join(script_dir, "config.ini"))
+
+host = config.get("API", "host", fallback="localhost")
+port = config.getint("API", "port", fallback=5000)
+workers = config.getint("API", "workers", fallback=1)
+threads = config.getint("API", "threads", fallback=8)
+
+logger = logging.getLogger("subscription.server")
+
+
+def serve_gunicorn():
+    from gunicorn.app.base import BaseApplication
+
+    # Every worker writes its metrics here and /metrics adds them up. It is
+    # created empty for this server and removed by this process only, the
+    # workers inherit the exit handler when they are forked.
+    metrics_dir = tempfile.mkdtemp(prefix="subscription-metrics-")
+    os.environ["SUBSCRIPTION_METRICS_DIR"] = metrics_dir
+    server_pid = os.getpid()
+
+    def remove_metrics_dir():
+        if os.getpid() == server_pid:
+            shutil.rmtree(metrics_dir, ignore_errors=True)
+
+    atexit.register(remove_metrics_dir)
+
+    class SubscriptionApplication(BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", f"{host}:{port}")
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            self.cfg.set("worker_class", "gthread")
+
+        # Imported in each worker, so every worker has its own store
+        def load(self):
+            from Subscription_API import app, init_store
+            init_store()
+            return app
+
+    SubscriptionApplication().run()
+
+
+def serve_waitress():
+    from waitress import serve
+    from Subscription_API import app, init_store
+    init_store()
+    serve(app, host=host, port=port, threads=threads)
+
+
+if __name__ == '__main__':
+    configure_logging(config, "api")
+    if workers > 1 and sys.platform != "win32":
+        logger.info("Serving the API", extra={"fields": {"host": host, "port": port, "workers": workers}})
+        serve_gunicorn()
+    else:
+        if workers > 1:
+            logger.warning("Several worker processes need gunicorn, which does not run on Windows; using one process")
+        logger.info("Serving the API", extra={"fields": {"host": host, "port": port, "threads": threads}})
+        serve_waitress()
@@ -0,0 +1,548 @@
+import threading
+import atexit
+import base64
+import json
+import logging
+import uuid
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime
+from StorageBackend import apply_operation
+
+logger = logging.getLogger("subscription.store")
+
+# How batches of changes reach the storage backend:
+#   immediate - every change is persisted before the request returns
+#   batched   - changes are collected and persisted every flush_interval_ms
+#   shutdown  - changes are kept in memory and persisted when the process exits
+FLUSH_POLICIES = ("immediate", "batched", "shutdown")
+
+# Sorts after every index in (end_date, index) pairs of the end_date index
+INFINITY = float("inf")
+
+# Fields /view_subscriptions can sort by, prefixed with "-" for descending order
+SORT_FIELDS = ("index", "client_name", "product_name", "end_date", "license_key")
+# Sorted keys kept for the most recent (filters, sort field) combinations
+QUERY_CACHE_SIZE = 8
+# Times a query is filtered and sorted outside the lock before giving up on
+# a moment without writes and sorting under it
+QUERY_SORT_ATTEMPTS = 3
+
+
+# End date as the end_date index compares it: YYYY-MM-DD zero-padded, so
+# dates stored before the API normalized them (2026-1-5) are found too.
+# None for anything that is not a date.
+def date_key(value):
+    if not isinstance(value, str):
+        return None
+    if len(value) == 10 and value[4] == "-" and value[7] == "-":
+        return value
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date().isoformat()
+    except ValueError:
+        return None
+
+
+# Sort key of a subscription. Names compare case-insensitively and the index
+# breaks ties, so every key is unique and can serve as a pagination cursor.
+def sort_key(subscription, field):
+    if field == "index":
+        return ("", subscription["index"])
+    value = str(subscription.get(field) or "")
+    if field == "end_date":
+        value = date_key(value) or value
+    else:
+        value = value.lower()
+    return (value, subscription["index"])
+
+
+def encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor):
+    try:
+        value, index = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (ValueError, TypeError):
+        raise ValueError("Invalid cursor.")
+    # Compared with sort keys, which are (str, int)
+    if not isinstance(value, str) or not isinstance(index, int) or isinstance(index, bool):
+        raise ValueError("Invalid cursor.")
+    return (value, index)
+
+
+# Raised by a change made against an older version of a subscription than its
+# current one: someone else changed it in the meantime
+class VersionConflict(Exception):
+    def __init__(self, subscription):
+        super().__init__(f"Subscription {subscription['index']} is at version {subscription['version']}.")
+        self.subscription = subscription
+
+
+def copy_operation(operation):
+    if operation["op"] == "add":
+        return dict(operation, subscription=dict(operation["subscription"]))
+    return operation
+
+
+class SubscriptionStore:
+    def __init__(self, backend, flush_policy="immediate", flush_interval_ms=500, change_feed_size=10000):
+        if flush_policy not in FLUSH_POLICIES:
+            raise ValueError(f"Unknown flush policy: {flush_policy}")
+
+        self.backend = backend
+        self.flush_policy = flush_policy
+        self.flush_interval = flush_interval_ms / 1000.0
+
+        self._lock = threading.RLock()
+        self._flush_lock = threading.Lock()
+        self._compact_lock = threading.Lock()
+        self._flush_timer = None
+        self._pending = []
+        self._closed = False
+        # The most recent operations, in seq order, served as a change feed
+        self._changes = deque(maxlen=change_feed_size)
+
+        # Several processes share the data (API workers): every change is made
+        # under the backend's cross-process lock, on top of the changes the
+        # other processes made, and persisted before the lock is released
+        self.shared = backend.shared
+        if self.shared:
+            self.flush_policy = "immediate"
+
+        # Everything is loaded once, reads are answered from memory afterwards
+        with backend.locked():
+            state = backend.load_state()
+            backend.recover(state)
+        self._load(state)
+        # Identifies this store instance in data versions, so versions handed
+        # out before a restart never match the data after it. Processes sharing
+        # the data persist every change at once and share their versions.
+        self._instance_id = "shared" if self.shared else uuid.uuid4().hex[:8]
+
+        self._compact_requested = threading.Event()
+        self._compactor = threading.Thread(target=self._compact_loop, daemon=True)
+        self._compactor.start()
+
+        atexit.register(self.close)
+
+    # Changes every time the data changes, used for ETags and response caching
+    @property
+    def version(self):
+        with self._lock:
+            self._refresh()
+            return f"{self._instance_id}-{self._state['last_seq']}"
+
+    # Operations recorded after seq, in order, with the current last seq.
+    # The operations are None when the feed no longer reaches back to seq (or
+    # seq is from another data set); the caller then has to load everything.
+    def changes_since(self, seq):
+        with self._lock:
+            self._refresh()
+            last_seq = self._state["last_seq"]
+            if seq == last_seq:
+                return [], last_seq
+            if seq > last_seq or not self._changes or self._changes[0]["seq"] > seq + 1:
+                return None, last_seq
+            return [operation for operation in self._changes if operation["seq"] > seq], last_seq
+
+    # Subscriptions
+
+    def get_subscriptions(self):
+        with self._lock:
+            self._refresh()
+            return [dict(subscription) for subscription in self._subscriptions.values()]
+
+    # All subscriptions with the seq they are current as of, taken together so
+    # a change feed reader can continue from there
+    def get_subscriptions_at(self):
+        with self._lock:
+            self._refresh()
+            return self.get_subscriptions(), self._state["last_seq"]
+
+    def get_subscription(self, index):
+        with self._lock:
+            self._refresh()
+            subscription = self._subscriptions.get(index)
+            return dict(subscription) if subscription is not None else None
+
+    # Filter, sort and page subscriptions. Pages after the first are addressed
+    # either by offset or by the cursor of the previous page (keyset
+    # pagination: the page starts right after the row the cursor names).
+    # Returns (page, next_cursor, total) where total counts the filtered rows.
+    # The sorted keys of a query are kept until the data changes, so the
+    # following pages cost O(log n + limit).
+    def query_subscriptions(self, q=None, product=None, end_before=None, end_after=None,
+                            sort="index", limit=None, cursor=None, offset=0):
+        descending = sort.startswith("-")
+        field = sort.lstrip("-")
+        if field not in SORT_FIELDS:
+            raise ValueError(f"Invalid sort field: {field}")
+        q = q.lower() if q else None
+        cursor_key = decode_cursor(cursor) if cursor is not None else None
+        query = (q, product, end_before, end_after, field)
+
+        for attempt in range(QUERY_SORT_ATTEMPTS):
+            with self._lock:
+                self._refresh()
+                seq = self._state["last_seq"]
+                cached = self._query_cache.get(query)
+                if cached is not None and cached[0] == seq:
+                    self._query_cache.move_to_end(query)
+                    return self._query_page(cached[1], descending, limit, cursor_key, offset)
+                matches = self._match_subscriptions(q, product, end_before, end_after, field)
+                # Writes kept changing the data while sorting, sort under the lock
+                if attempt == QUERY_SORT_ATTEMPTS - 1:
+                    matches.sort()
+                    return self._cache_query_page(query, seq, matches, descending, limit, cursor_key, offset)
+            # Sorted outside the lock, writers are not held up meanwhile
+            matches.sort()
+            with self._lock:
+                # Otherwise the data changed while sorting: filter again
+                if self._state["last_seq"] == seq:
+                    return self._cache_query_page(query, seq, matches, descending, limit, cursor_key, offset)
+
+    # Called with the lock held
+    def _cache_query_page(self, query, seq, keys, descending, limit, cursor_key, offset):
+        self._query_cache[query] = (seq, keys)
+        while len(self._query_cache) > QUERY_CACHE_SIZE:
+            self._query_cache.popitem(last=False)
+        return self._query_page(keys, descending, limit, cursor_key, offset)
+
+    # Called with the lock held: sort keys of the subscriptions that pass the
+    # filters, unsorted
+    def _match_subscriptions(self, q, product, end_before, end_after, field):
+        # A date filter narrows the candidates through the end_date index
+        if end_before is not None or end_after is not None:
+            low = bisect_right(self._end_dates, (end_after, INFINITY)) if end_after is not None else 0
+            high = bisect_left(self._end_dates, (end_before,)) if end_before is not None else len(self._end_dates)
+            candidates = (self._subscriptions[index] for _, index in self._end_dates[low:high])
+        else:
+            candidates = self._subscriptions.values()
+
+        matches = []
+        for subscription in candidates:
+            if product is not None and subscription.get("product_name") != product:
+                continue
+            if q is not None and q not in str(subscription.get("client_name") or "").lower() \
+                    and q not in str(subscription.get("product_name") or "").lower():
+                continue
+            matches.append(sort_key(subscription, field))
+        return matches
+
+    # Called with the lock held, keys being the sorted keys of the current data
+    def _query_page(self, keys, descending, limit, cursor_key, offset):
+        total = len(keys)
+        if not descending:
+            start = bisect_right(keys, cursor_key) if cursor_key is not None else 0
+            start += offset
+            stop = total if limit is None else min(start + limit, total)
+            page = keys[start:stop]
+            more = stop < total
+        else:
+            stop = bisect_left(keys, cursor_key) if cursor_key is not None else total
+            stop = max(stop - offset, 0)
+            start = 0 if limit is None else max(stop - limit, 0)
+            page = keys[start:stop][::-1]
+            more = start > 0
+        next_cursor = encode_cursor(page[-1]) if limit is not None and more and page else None
+        return [dict(self._subscriptions[key[1]]) for key in page], next_cursor, total
+
+    # Subscriptions ending between start and end (YYYY-MM-DD, both inclusive),
+    # ordered by end date. Costs O(log n + k) through the end_date index.
+    def expiring(self, start, end):
+        with self._lock:
+            self._refresh()
+            low = bisect_left(self._end_dates, (start,))
+            high = bisect_right(self._end_dates, (end, INFINITY))
+            return [dict(self._subscriptions[index]) for _, index in self._end_dates[low:high]]
+
+    def add_subscription(self, data):
+        with self._writing():
+            subscription = dict(data)
+            subscription["index"] = self._state["next_index"]
+            subscription["version"] = 1
+            self._record({"op": "add", "subscription": subscription})
+        return dict(subscription)
+
+    # Add a batch of subscriptions, persisted together in one flush
+    def add_subscriptions(self, items):
+        added = []
+        with self._writing():
+            for data in items:
+                subscription = dict(data)
+                subscription["index"] = self._state["next_index"]
+                subscription["version"] = 1
+                self._record({"op": "add", "subscription": subscription})
+                added.append(dict(subscription))
+        return added
+
+    # Every subscription carries a version, bumped by each renewal. With
+    # expected_version the change is only made while the subscription is still
+    # at that version (compare-and-set), otherwise VersionConflict is raised.
+    # The check and the change happen under the same lock.
+
+    def delete_subscription(self, index, expected_version=None):
+        with self._writing():
+            subscription = self._subscriptions.get(index)
+            if subscription is None:
+                return False
+            self._check_version(subscription, expected_version)
+            self._record({"op": "delete", "index": index})
+        return True
+
+    # Returns the renewed subscription, None when the index does not exist
+    def renew_subscription(self, index, new_end_date=None, new_license_key=None, expected_version=None):
+        with self._writing():
+            subscription = self._subscriptions.get(index)
+            if subscription is None:
+                return None
+            self._check_version(subscription, expected_version)
+            self._record({"op": "renew", "index": index, "end_date": new_end_date or None,
+                          "license_key": new_license_key or None, "version": subscription["version"] + 1})
+            return dict(subscription)
+
+    def _check_version(self, subscription, expected_version):
+        if expected_version is not None and expected_version != subscription["version"]:
+            raise VersionConflict(dict(subscription))
+
+    # Products
+
+    def get_products(self):
+        with self._lock:
+            self._refresh()
+            return list(self._products)
+
+    # Products whose name starts with q, then those containing it elsewhere,
+    # both case-insensitive and in alphabetical order, at most limit of them.
+    # Prefix matches cost O(log n + k) through the sorted names.
+    def search_products(self, q, limit=None):
+        q = q.lower()
+        with self._lock:
+            self._refresh()
+            low = bisect_left(self._product_names, (q,))
+            high = bisect_left(self._product_names, (q + "\U0010ffff",))
+            matches = [name for _, name in self._product_names[low:high]]
+            if limit is not None and len(matches) >= limit:
+                return matches[:limit]
+            for key, name in self._product_names:
+                if q in key and not key.startswith(q):
+                    matches.append(name)
+                    if limit is not None and len(matches) >= limit:
+                        break
+            return matches
+
+    def add_product(self, product_name):
+        with self._writing():
+            if product_name in self._products:
+                return False
+            self._record({"op": "add_product", "product_name": product_name})
+        return True
+
+    # Add a batch of products, returns for each one whether it was new
+    def add_products(self, product_names):
+        results = []
+        with self._writing():
+            for product_name in product_names:
+                if product_name in self._products:
+                    results.append(False)
+                    continue
+                self._record({"op": "add_product", "product_name": product_name})
+                results.append(True)
+        return results
+
+    def delete_product(self, product_name):
+        with self._writing():
+            if product_name not in self._products:
+                return False
+            self._record({"op": "delete_product", "product_name": product_name})
+        return True
+
+    # Persistence
+
+    # Called with the lock held: (re)build the state and its indexes
+    def _load(self, state):
+        self._state = state
+        self._subscriptions = state["subscriptions"]
+        self._products = state["products"]
+        # Subscriptions saved before versions existed are at version 1
+        for subscription in self._subscriptions.values():
+            subscription.setdefault("version", 1)
+        # (end_date, index) pairs kept sorted, for date range queries by binary search
+        end_dates = ((date_key(subscription.get("end_date")), index)
+                     for index, subscription in self._subscriptions.items())
+        self._end_dates = sorted(entry for entry in end_dates if entry[0] is not None)
+        # (lowercase name, name) pairs kept sorted, for prefix search by binary search
+        self._product_names = sorted((name.lower(), name) for name in self._products)
+        # (q, product, end_before, end_after, sort field) -> (last_seq, sorted
+        # keys) of recent queries, see query_subscriptions
+        self._query_cache = OrderedDict()
+
+    # Called with the lock held: take in what other processes changed
+    def _refresh(self):
+        if self.shared and self.backend.changed():
+            with self.backend.locked():
+                self._sync()
+
+    # Called with the lock and the backend's lock held
+    def _sync(self):
+        operations, state = self.backend.sync()
+        if state is not None:
+            self._load(state)
+            self._changes.clear()
+            return
+        for operation in operations:
+            if operation.get("seq", 0) > self._state["last_seq"]:
+                self._changes.append(copy_operation(operation))
+                self._apply(operation)
+
+    # Every change is made inside this, see shared above
+    @contextmanager
+    def _writing(self):
+        with self._lock:
+            if not self.shared:
+                yield
+            else:
+                with self.backend.locked():
+                    self._sync()
+                    yield
+                    self._append_pending()
+        self._flush_if_immediate()
+
+    # Called with the lock and the backend's lock held
+    def _append_pending(self):
+        pending = self._pending
+        self._pending = []
+        if not pending:
+            return
+        try:
+            self.backend.append(pending)
+        except BaseException:
+            self._pending = pending + self._pending
+            raise
+        if self.backend.needs_compaction():
+            self._compact_requested.set()
+
+    # Called with the lock held: applies the operation in memory and queues it
+    # for the backend. The operation is copied so later changes to the record
+    # in memory do not leak into the queued batch.
+    def _record(self, operation):
+        operation["seq"] = self._state["last_seq"] + 1
+        queued = copy_operation(operation)
+        self._pending.append(queued)
+        self._changes.append(queued)
+        self._apply(operation)
+        if self.flush_policy == "batched" and self._flush_timer is None:
+            self._flush_timer = threading.Timer(self.flush_interval, self._timer_flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    # Called with the lock held: apply_operation plus the upkeep of the indexes
+    def _apply(self, operation):
+        if operation["op"] == "add":
+            index = operation["subscription"]["index"]
+        else:
+            index = operation.get("index")
+
+        old_end_date = self._subscriptions.get(index, {}).get("end_date")
+        if operation["op"] == "add_product" and operation["product_name"] not in self._products:
+            insort(self._product_names, (operation["product_name"].lower(), operation["product_name"]))
+        elif operation["op"] == "delete_product" and operation["product_name"] in self._products:
+            name = operation["product_name"]
+            del self._product_names[bisect_left(self._product_names, (name.lower(), name))]
+        apply_operation(self._state, operation)
+        new_end_date = self._subscriptions.get(index, {}).get("end_date")
+        if old_end_date != new_end_date:
+            self._update_end_date_index(index, old_end_date, new_end_date)
+
+    # Called with the lock held
+    def _update_end_date_index(self, index, old_end_date, new_end_date):
+        old_key, new_key = date_key(old_end_date), date_key(new_end_date)
+        if old_key is not None:
+            position = bisect_left(self._end_dates, (old_key, index))
+            if position < len(self._end_dates) and self._end_dates[position] == (old_key, index):
+                del self._end_dates[position]
+        if new_key is not None:
+            insort(self._end_dates, (new_key, index))
+
+    # Called after the lock is released, flush() takes the locks itself
+    def _flush_if_immediate(self):
+        if self.flush_policy == "immediate":
+            self.flush()
+
+    def _timer_flush(self):
+        with self._lock:
+            self._flush_timer = None
+        self.flush()
+
+    def flush(self):
+        # Batches are handed to the backend one at a time and in order
+        with self._flush_lock:
+            with self._lock:
+                pending = self._pending
+                self._pending = []
+            if not pending:
+                return
+            try:
+                self.backend.append(pending)
+            except BaseException:
+                with self._lock:
+                    self._pending = pending + self._pending
+                raise
+            logger.debug("Batch persisted", extra={"fields": {"operations": len(pending)}})
+            if self.backend.needs_compaction():
+                self._compact_requested.set()
+
+    def _snapshot(self):
+        with self._lock:
+            return {
+                "subscriptions": [dict(subscription) for subscription in self._subscriptions.values()],
+                "products": list(self._products),
+                "next_index": self._state["next_index"],
+                "last_seq": self._state["last_seq"],
+            }
+
+    def _compact_loop(self):
+        while True:
+            self._compact_requested.wait()
+            self._compact_requested.clear()
+            if self._closed:
+                return
+            try:
+                self.compact()
+            except Exception:
+                logger.exception("Error compacting journal")
+
+    # Fold the journal into a fresh snapshot. Writers are only held up while the
+    # journal is swapped, the snapshot itself is written afterwards.
+    def compact(self):
+        with self._compact_lock:
+            self.flush()
+            if self.shared:
+                # Other processes wait for the whole compaction
+                with self._lock, self.backend.locked():
+                    self._sync()
+                    snapshot = self._snapshot()
+                    self.backend.begin_compaction()
+                    self.backend.finish_compaction(snapshot)
+                return
+            with self._flush_lock:
+                snapshot = self._snapshot()
+                self.backend.begin_compaction()
+            self.backend.finish_compaction(snapshot)
+
+    def close(self):
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+        self.flush()
+        # Leave a clean snapshot behind when anything is left in the journal
+        if self.backend.needs_compaction(threshold_bytes=0):
+            self.compact()
+        self._compact_requested.set()
+        self.backend.close()
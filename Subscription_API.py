@@ -1,12 +1,20 @@
-from flask import Flask, request, jsonify
+from flask import Flask, request, jsonify, g
 import json
+import logging
 import configparser
 import os
 import sys
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from SubscriptionStore import SubscriptionStore, VersionConflict
+from StorageBackend import create_backend
+from SubscriptionMetrics import REGISTRY, CONTENT_TYPE, SharedMetrics
+from SubscriptionLogging import configure_logging
 
 app = Flask(__name__)
-
-print("RUNNING...API")
+logger = logging.getLogger("subscription.api")
 
 # Get the directory of the script
 if getattr(sys, 'frozen', False):  # if the application is frozen (e.g. pyinstaller)
@@ -17,69 +25,302 @@ else:
 # Load configurations from config.ini
 config = configparser.ConfigParser()
 config_file_path = os.path.join(script_dir, "config.ini")
-if os.path.exists(config_file_path):
-    config.read(config_file_path)
-    print("config.ini found")
+config.read(config_file_path)
+configure_logging(config, "api")
+logger.info("API starting")
+if not os.path.exists(config_file_path):
+    logger.warning("config.ini not found, using the defaults", extra={"fields": {"path": config_file_path}})
 
 # Get API configuration
 api_host = config.get("API", "host", fallback="localhost")
 api_port = config.getint("API", "port", fallback=5000)
+# With several worker processes (SubscriptionServer.py) they share the data files
+api_workers = config.getint("API", "workers", fallback=1)
 
-# Load subscriptions
-def load_subscriptions():
-    try:
-        with open(os.path.join(script_dir, "subscriptions.json"), "r") as file:
-            return json.load(file)
-    except FileNotFoundError:
-        return []
-
-# Save subscriptions
-def save_subscriptions(subscriptions):
-    with open(os.path.join(script_dir, "subscriptions.json"), "w") as file:
-        json.dump(subscriptions, file)
-
-# Load products
-def load_products():
-    try:
-        with open(os.path.join(script_dir, "products.json"), "r") as file:
-            return json.load(file)
-    except FileNotFoundError:
-        return []
+# Get storage configuration
+flush_policy = config.get("Storage", "flush_policy", fallback="immediate")
+flush_interval_ms = config.getint("Storage", "flush_interval_ms", fallback=500)
+
+# Subscriptions and products are loaded once and served from memory, changes
+# are persisted through the backend selected in the [Storage] section. The
+# store is created by init_store(), not on import: the entry points (this
+# script, SubscriptionServer.py) call it, and a request arriving first creates
+# it. A tool importing the module (the benchmark) sets store to its own one
+# instead, and the data files next to the script are never opened.
+store = None
+store_lock = threading.Lock()
+
+def init_store(data_dir=None):
+    global store
+    with store_lock:
+        if store is None:
+            store = SubscriptionStore(create_backend(config, data_dir or script_dir, shared=api_workers > 1),
+                                      flush_policy=flush_policy, flush_interval_ms=flush_interval_ms)
+        return store
+
+# Request metrics, served with the storage metrics on /metrics
+REQUESTS = REGISTRY.counter("subscription_api_requests_total", "Requests answered, by endpoint, method and status.",
+                            ("endpoint", "method", "status"))
+REQUEST_SECONDS = REGISTRY.histogram("subscription_api_request_duration_seconds",
+                                     "Time to answer a request, by endpoint and method.", ("endpoint", "method"))
+
+@app.before_request
+def start_request_timer():
+    g.request_start = time.perf_counter()
 
-# Save products
-def save_products(products):
-    with open(os.path.join(script_dir, "products.json"), "w") as file:
-        json.dump(products, file)
+@app.before_request
+def ensure_store():
+    if store is None:
+        init_store()
 
-# Generate a unique index for new subscriptions
-def generate_index(subscriptions):
-    indexes = [subscription.get("index", 0) for subscription in subscriptions]
-    return max(indexes) + 1 if indexes else 1
+@app.after_request
+def record_request_metrics(response):
+    # Unknown URLs share one label value, so they cannot blow up the series count
+    endpoint = request.endpoint or "unmatched"
+    REQUESTS.inc(endpoint=endpoint, method=request.method, status=response.status_code)
+    start = g.get("request_start")
+    if start is not None:
+        REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint, method=request.method)
+    return response
+
+# Worker processes started by SubscriptionServer.py share their metrics
+# through this directory, so any of them answers /metrics for all of them
+metrics_dir = os.environ.get("SUBSCRIPTION_METRICS_DIR")
+shared_metrics = SharedMetrics(REGISTRY, metrics_dir) if metrics_dir else None
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    body = shared_metrics.render() if shared_metrics is not None else REGISTRY.render()
+    return app.response_class(body, content_type=CONTENT_TYPE)
 
 @app.route('/add_subscription', methods=['POST'])
 def add_subscription():
     try:
         data = request.json
-        print("Received request data:", data)
-        subscriptions = load_subscriptions()
+        logger.debug("Add subscription requested", extra={"fields": {"subscription": data}})
 
         # Check if the license key is provided
         if "license_key" not in data:
             return jsonify({"error": "License key is required."}), 400
+        try:
+            data = normalize_end_date(data)
+        except ValueError as e:
+            return jsonify({"error": str(e)}), 400
 
-        data["index"] = generate_index(subscriptions)
-        subscriptions.append(data)
-        save_subscriptions(subscriptions)
-        print("Subscription added:", data)
+        data = store.add_subscription(data)
+        logger.info("Subscription added", extra={"fields": {"index": data["index"]}})
         return jsonify({"message": "Subscription added successfully."}), 200
-    except Exception as e:
-        print("Error:", e)
+    except Exception:
+        logger.exception("Error adding subscription")
         return jsonify({"error": "Internal Server Error"}), 500
 
+# Items of a bulk request: a JSON list, or an object holding the list under key
+def get_bulk_items(key):
+    data = request.json
+    if isinstance(data, dict):
+        data = data.get(key)
+    if not isinstance(data, list):
+        return None
+    return data
+
+# Serialized GET responses, keyed by URL and tagged with the data version they
+# were built from. A response is only rebuilt after the data changed. The
+# cache is bounded by the size of the bodies as well as their number, and a
+# body too large to be worth keeping (the full list of a big data set) is
+# served without being cached.
+RESPONSE_CACHE_SIZE = 128
+RESPONSE_CACHE_BYTES = 64 * 1024 * 1024
+RESPONSE_CACHE_MAX_BODY = RESPONSE_CACHE_BYTES // 8
+
+class ResponseCache:
+    def __init__(self, max_entries, max_bytes, max_body):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_body = max_body
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key, version, body):
+        if len(body) > self.max_body:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= len(previous[1])
+            self._entries[key] = (version, body)
+            self.bytes += len(body)
+            while len(self._entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self.bytes -= len(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.bytes = 0
+
+response_cache = ResponseCache(RESPONSE_CACHE_SIZE, RESPONSE_CACHE_BYTES, RESPONSE_CACHE_MAX_BODY)
+
+def cached_json_response(build):
+    version = store.version
+    # The ETag is the data version, a client holding it already has this
+    # response: nothing needs to be built
+    if request.if_none_match.contains(version):
+        response = app.response_class(status=304)
+        response.set_etag(version)
+        return response
+
+    key = request.full_path
+    entry = response_cache.get(key)
+    if entry is None or entry[0] != version:
+        result = build()
+        # Errors are passed through and never cached
+        if isinstance(result, tuple):
+            return result
+        entry = (version, app.json.dumps(result).encode("utf-8"))
+        response_cache.put(key, *entry)
+
+    response = app.response_class(entry[1], mimetype="application/json")
+    response.set_etag(version)
+    return response
+
+# A YYYY-MM-DD date in its zero-padded form (2026-1-5 -> 2026-01-05), the
+# form the end_date index compares. Raises ValueError for anything else.
+def normalize_date(value):
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").date().isoformat()
+    except (TypeError, ValueError):
+        raise ValueError("Dates must be in YYYY-MM-DD format.")
+
+# Parse an optional YYYY-MM-DD query parameter
+def get_date_arg(name):
+    value = request.args.get(name)
+    if value is not None:
+        value = normalize_date(value)
+    return value
+
+# Validate the end_date of a subscription to add and store it zero-padded
+def normalize_end_date(data):
+    if data.get("end_date") is not None:
+        try:
+            return dict(data, end_date=normalize_date(data["end_date"]))
+        except ValueError:
+            raise ValueError("end_date must be a date in YYYY-MM-DD format.")
+    return data
+
+# Validate and add a batch of subscriptions in a single persistence pass.
+# Every item gets its own result, invalid items do not stop the others.
+@app.route('/add_subscriptions_bulk', methods=['POST'])
+def add_subscriptions_bulk():
+    items = get_bulk_items("subscriptions")
+    if items is None:
+        return jsonify({"error": "A list of subscriptions is required."}), 400
+
+    results = [None] * len(items)
+    valid = []
+    for position, data in enumerate(items):
+        if not isinstance(data, dict):
+            results[position] = {"status": 400, "error": "Subscription must be an object."}
+        elif "license_key" not in data:
+            results[position] = {"status": 400, "error": "License key is required."}
+        else:
+            try:
+                items[position] = normalize_end_date(data)
+            except ValueError as e:
+                results[position] = {"status": 400, "error": str(e)}
+                continue
+            valid.append(position)
+
+    added = store.add_subscriptions([items[position] for position in valid])
+    for position, subscription in zip(valid, added):
+        results[position] = {"status": 200, "index": subscription["index"]}
+
+    logger.info("Bulk add", extra={"fields": {"added": len(added), "received": len(items)}})
+    return jsonify({"added": len(added), "results": results}), 200
+
 @app.route('/view_subscriptions', methods=['GET'])
 def view_subscriptions():
-    subscriptions = load_subscriptions()
-    return jsonify(subscriptions), 200
+    return cached_json_response(query_subscriptions)
+
+def query_subscriptions():
+    # Without query parameters the whole list is returned, as before
+    if not request.args:
+        return store.get_subscriptions()
+
+    try:
+        limit = request.args.get("limit", type=int)
+        offset = request.args.get("offset", 0, type=int)
+        if "limit" in request.args and (limit is None or limit < 1):
+            raise ValueError("limit must be a positive integer.")
+        if offset is None or offset < 0:
+            raise ValueError("offset must be a non-negative integer.")
+        subscriptions, next_cursor, total = store.query_subscriptions(
+            q=request.args.get("q") or None,
+            product=request.args.get("product") or None,
+            end_before=get_date_arg("end_before"),
+            end_after=get_date_arg("end_after"),
+            sort=request.args.get("sort", "index"),
+            limit=limit,
+            cursor=request.args.get("cursor") or None,
+            offset=offset,
+        )
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    return {"subscriptions": subscriptions, "next_cursor": next_cursor, "total": total}
+
+# Subscriptions ending in a date range, both ends inclusive
+@app.route('/expiring', methods=['GET'])
+def expiring():
+    return cached_json_response(query_expiring)
+
+def query_expiring():
+    try:
+        start = get_date_arg("from")
+        end = get_date_arg("to")
+    except ValueError:
+        return jsonify({"error": "from and to must be dates in YYYY-MM-DD format."}), 400
+    if start is None or end is None:
+        return jsonify({"error": "from and to are required."}), 400
+    return store.expiring(start, end)
+
+# Operations applied since the seq a reader last saw, so it can keep a copy of
+# the subscriptions up to date without downloading all of them on every check.
+# When the feed no longer reaches back that far the whole list is returned
+# with "reset": true.
+@app.route('/changes', methods=['GET'])
+def changes():
+    since = request.args.get("since", type=int)
+    if "since" not in request.args:
+        since = 0
+    elif since is None or since < 0:
+        return jsonify({"error": "since must be a non-negative integer."}), 400
+    operations, last_seq = store.changes_since(since)
+    if operations is not None:
+        return jsonify({"last_seq": last_seq, "changes": operations})
+    subscriptions, last_seq = store.get_subscriptions_at()
+    return jsonify({"last_seq": last_seq, "reset": True, "subscriptions": subscriptions})
+
+# Optional expected_version of a change: the version of the subscription the
+# client last saw. The change is refused with 409 when it no longer matches.
+def get_expected_version():
+    expected_version = request.json.get("expected_version")
+    if expected_version is not None and (isinstance(expected_version, bool) or not isinstance(expected_version, int)):
+        raise ValueError("expected_version must be an integer.")
+    return expected_version
+
+def version_conflict(error):
+    logger.info("Version conflict", extra={"fields": {"index": error.subscription["index"],
+                                                       "version": error.subscription["version"]}})
+    return jsonify({"message": "Subscription was changed by someone else.",
+                    "subscription": error.subscription}), 409
 
 @app.route('/delete_subscription', methods=['DELETE'])
 def delete_subscription():
@@ -87,17 +328,17 @@ def delete_subscription():
         index = request.json.get("index")
         if index is None:
             return jsonify({"message": "Index is required."}), 400
+        try:
+            expected_version = get_expected_version()
+        except ValueError as e:
+            return jsonify({"message": str(e)}), 400
 
-        subscriptions = load_subscriptions()
-        index_exists = False
-        for subscription in subscriptions:
-            if subscription["index"] == index:
-                subscriptions.remove(subscription)
-                index_exists = True
-                break
-
-        if index_exists:
-            save_subscriptions(subscriptions)
+        try:
+            deleted = store.delete_subscription(index, expected_version)
+        except VersionConflict as e:
+            return version_conflict(e)
+        if deleted:
+            logger.info("Subscription deleted", extra={"fields": {"index": index}})
             return jsonify({"message": "Subscription deleted successfully."}), 200
         else:
             return jsonify({"message": "Invalid index."}), 404
@@ -109,16 +350,20 @@ def renew_subscription():
     index = request.json.get("index")
     new_end_date = request.json.get("new_end_date")
     new_license_key = request.json.get("new_license_key")
-    subscriptions = load_subscriptions()
+    try:
+        expected_version = get_expected_version()
+        if new_end_date:
+            new_end_date = normalize_date(new_end_date)
+    except ValueError as e:
+        return jsonify({"message": str(e)}), 400
 
-    for subscription in subscriptions:
-        if subscription["index"] == index:
-            if new_end_date:
-                subscription["end_date"] = new_end_date
-            if new_license_key:
-                subscription["license_key"] = new_license_key
-            save_subscriptions(subscriptions)
-            return jsonify({"message": "Subscription renewed successfully."}), 200
+    try:
+        subscription = store.renew_subscription(index, new_end_date, new_license_key, expected_version)
+    except VersionConflict as e:
+        return version_conflict(e)
+    if subscription is not None:
+        logger.info("Subscription renewed", extra={"fields": {"index": index, "version": subscription["version"]}})
+        return jsonify({"message": "Subscription renewed successfully.", "version": subscription["version"]}), 200
 
     return jsonify({"message": "Invalid index."}), 400
 
@@ -129,26 +374,59 @@ def is_api_online():
 
 @app.route('/get_products', methods=['GET'])
 def get_products():
-    products = load_products()
-    return jsonify(products), 200
+    return cached_json_response(store.get_products)
+
+# Product picker search: names starting with q first, then names containing
+# it, case-insensitive, at most limit (default 20) of them
+@app.route('/search_products', methods=['GET'])
+def search_products():
+    return cached_json_response(query_products)
+
+def query_products():
+    limit = request.args.get("limit", type=int)
+    if "limit" not in request.args:
+        limit = 20
+    elif limit is None or limit < 1:
+        return jsonify({"error": "limit must be a positive integer."}), 400
+    return store.search_products(request.args.get("q", ""), limit)
 
 @app.route('/add_product', methods=['POST'])
 def add_product():
     product_name = request.json.get("product_name")
-    if product_name:
-        products = load_products()
-
+    if isinstance(product_name, str) and product_name:
         # Check if the product already exists
-        if product_name in products:
+        if not store.add_product(product_name):
             return jsonify({"error": "Product already exists."}), 400
 
-        products.append(product_name)
-        save_products(products)
         return jsonify({"message": "Product added successfully."}), 200
     else:
         return jsonify({"message": "Invalid product name."}), 400
 
 
+@app.route('/add_products_bulk', methods=['POST'])
+def add_products_bulk():
+    product_names = get_bulk_items("product_names")
+    if product_names is None:
+        return jsonify({"error": "A list of product names is required."}), 400
+
+    results = [None] * len(product_names)
+    valid = []
+    for position, product_name in enumerate(product_names):
+        if isinstance(product_name, str) and product_name:
+            valid.append(position)
+        else:
+            results[position] = {"status": 400, "error": "Invalid product name."}
+
+    added = store.add_products([product_names[position] for position in valid])
+    for position, was_added in zip(valid, added):
+        if was_added:
+            results[position] = {"status": 200}
+        else:
+            results[position] = {"status": 400, "error": "Product already exists."}
+
+    return jsonify({"added": sum(added), "results": results}), 200
+
+
 @app.route('/delete_product', methods=['DELETE'])
 def delete_product():
     if request.method == 'DELETE':
@@ -156,10 +434,7 @@ def delete_product():
         if not product_name:
             return jsonify({"message": "Product name is required."}), 400
 
-        products = load_products()
-        if product_name in products:
-            products.remove(product_name)
-            save_products(products)
+        if store.delete_product(product_name):
             return jsonify({"message": "Product deleted successfully."}), 200
         else:
             return jsonify({"message": "Product does not exist."}), 404
@@ -175,4 +450,5 @@ if __name__ == '__main__':
     if not os.path.exists(products_file_path):
         with open(products_file_path, "w") as file:
             json.dump([], file)
+    init_store()
     app.run(host=api_host, port=api_port, debug=True, use_reloader=False)  # Run the Flask app